@@ -0,0 +1,63 @@
+import asyncio
+import itertools
+import time
+
+from aiohttp import web
+
+TOKEN_PATH = '/bot{token}/{method}'
+
+
+class FakeBotAPI:
+    """Local stand-in for the Bot API answering every method with a minimal valid result
+
+    ``latency`` seconds are slept before every answer to imitate the network.
+    """
+
+    def __init__(self, latency: float = 0):
+        self.latency = latency
+        self.calls: dict[str, int] = {}
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._runner: web.AppRunner | None = None
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post(TOKEN_PATH, self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_port = site._server.sockets[0].getsockname()[1]
+        return f'http://{host}:{bound_port}'
+
+    async def close(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        data = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.json_response({'ok': True, 'result': self._result(method, data)})
+
+    def _result(self, method: str, data) -> dict | bool:
+        if method == 'getme':
+            return {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if method in ('sendmessage', 'editmessagetext', 'senddocument'):
+            message = {
+                'message_id': next(self._message_ids),
+                'date': int(time.time()),
+                'chat': {'id': int(data.get('chat_id', 0)), 'type': 'private'},
+            }
+            if method == 'senddocument':
+                file_number = next(self._file_ids)
+                message['document'] = {
+                    'file_id': f'bench-file-{file_number}',
+                    'file_unique_id': f'bench-unique-{file_number}',
+                }
+            else:
+                message['text'] = data.get('text', '')
+            return message
+        return True
@@ -0,0 +1,53 @@
+import random
+from datetime import datetime, timedelta
+
+import db
+
+BENCH_TELEGRAM_ID_OFFSET = 10 ** 12
+BENCH_USER_POINTS = 10 ** 9
+BATCH_SIZE = 10_000
+WORDS = ('late', 'again', 'forgot', 'the', 'meeting', 'dishes', 'keys', 'never', 'called', 'back')
+
+
+def seed_users(users_count: int) -> list[int]:
+    """Create bench users with practically unlimited points, return their ids"""
+    telegram_ids = [BENCH_TELEGRAM_ID_OFFSET + number for number in range(users_count)]
+    rows = [
+        {'name': f'Bench {number}', 'telegram_id': telegram_id, 'points': BENCH_USER_POINTS}
+        for number, telegram_id in enumerate(telegram_ids)
+    ]
+    with db.engine.atomic():
+        db.User.insert_many(rows).on_conflict_ignore().execute()
+        (db.User
+         .update(points=BENCH_USER_POINTS)
+         .where(db.User.telegram_id.in_(telegram_ids))
+         .execute())
+    return [user.id for user in db.User.select(db.User.id).where(db.User.telegram_id.in_(telegram_ids))]
+
+
+def seed_disappointments(user_ids: list[int], disappointments_count: int, seed: int = 0) -> int:
+    """Insert disappointments between bench users until the table holds ``disappointments_count`` rows"""
+    missing = disappointments_count - db.Disappointment.select().count()
+    if missing <= 0:
+        return 0
+    randomizer = random.Random(seed)
+    now = datetime.now()
+    inserted = 0
+    while inserted < missing:
+        rows = [
+            {
+                'from_user': randomizer.choice(user_ids),
+                'to_user': randomizer.choice(user_ids),
+                'reason': ' '.join(randomizer.choices(WORDS, k=randomizer.randint(2, 12))),
+                'created_at': now - timedelta(seconds=randomizer.randint(0, 365 * 24 * 60 * 60)),
+            }
+            for _ in range(min(BATCH_SIZE, missing - inserted))
+        ]
+        with db.engine.atomic():
+            db.Disappointment.insert_many(rows).execute()
+        inserted += len(rows)
+        print(f'Seeded {inserted} of {missing} disappointments')
+    db.reconcile_user_stats()
+    db.reconcile_daily_stats(days=None)
+    db.engine.execute_sql('ANALYZE')
+    return inserted
@@ -0,0 +1,114 @@
+import gzip
+import io
+import json
+from datetime import date, datetime
+from typing import Iterable, Iterator
+
+from peewee import EXCLUDED
+
+import db
+import partitions
+import settings
+from utils import logger
+
+
+def _dump_rows(disappointments: Iterable[db.DisappointmentRow]) -> tuple[bytes, int]:
+    """Gzipped NDJSON of the rows and their number"""
+    buffer = io.BytesIO()
+    count = 0
+    with gzip.GzipFile(fileobj=buffer, mode='wb') as compressed_file:
+        for disappointment in disappointments:
+            row = disappointment._asdict()
+            row['created_at'] = disappointment.created_at.isoformat()
+            compressed_file.write(json.dumps(row, ensure_ascii=False).encode() + b'\n')
+            count += 1
+    return buffer.getvalue(), count
+
+
+def _load_rows(content: bytes) -> Iterator[db.DisappointmentRow]:
+    # Archiving the same month again appends a gzip member, gzip reads all of them
+    with gzip.GzipFile(fileobj=io.BytesIO(content), mode='rb') as compressed_file:
+        for line in compressed_file:
+            row = json.loads(line)
+            row['created_at'] = datetime.fromisoformat(row['created_at'])
+            yield db.DisappointmentRow(**row)
+
+
+def archive_month(month: date) -> int:
+    """Move disappointments of the month to the archive, return the number of moved ones
+
+    With partitioning the month's partition is dropped instead of deleting its rows one by one.
+    The moved disappointments are added to the archived stats of their users, so user stats keep them.
+    """
+    start, end = partitions.get_month_bounds(month)
+    is_in_month = (db.Disappointment.created_at >= start) & (db.Disappointment.created_at < end)
+    with db.engine.atomic():
+        content, count = _dump_rows(db.iter_disappointments(since=start, until=end))
+        if count:
+            db.archive_user_stats(start, end)
+            (db.DisappointmentArchive
+             .insert(month=month, disappointments_count=count, content=content)
+             .on_conflict(
+                 conflict_target=(db.DisappointmentArchive.month,),
+                 update={
+                     db.DisappointmentArchive.disappointments_count: (
+                         db.DisappointmentArchive.disappointments_count + EXCLUDED.disappointments_count
+                     ),
+                     db.DisappointmentArchive.content: (
+                         db.DisappointmentArchive.content.concat(EXCLUDED.content)
+                     ),
+                     db.DisappointmentArchive.archived_at: datetime.now(),
+                 },
+             )
+             .execute())
+        if partitions.is_partitioned() and partitions.partition_exists(month):
+            partitions.drop_partition(month)
+        else:
+            db.Disappointment.delete().where(is_in_month).execute()
+    if count:
+        db._bump_disappointments_changes_counter()
+        logger.info(f'Archived {count} disappointments of {month:%Y-%m}')
+    return count
+
+
+def archive_expired_months(
+        retention_months: int | None = settings.DISAPPOINTMENTS_RETENTION_MONTHS,
+) -> int:
+    """Archive months older than ``retention_months`` full months, return the number of moved rows"""
+    if retention_months is None:
+        return 0
+    first_kept_month = partitions.add_months(partitions.get_month_start(date.today()), -retention_months)
+    oldest_created_at = (db.Disappointment
+                         .select(db.Disappointment.created_at)
+                         .order_by(db.Disappointment.created_at)
+                         .limit(1)
+                         .scalar())
+    if oldest_created_at is None:
+        return 0
+    archived_count = 0
+    month = partitions.get_month_start(oldest_created_at.date())
+    while month < first_kept_month:
+        archived_count += archive_month(month)
+        month = partitions.add_months(month, 1)
+    return archived_count
+
+
+def maintain_disappointments_storage() -> None:
+    if partitions.is_partitioned():
+        partitions.create_partitions_ahead()
+    archive_expired_months()
+
+
+def iter_archived_disappointments(since: datetime | None = None) -> Iterator[db.DisappointmentRow]:
+    """Iterate over archived disappointments created since ``since``, one month is read at a time"""
+    months = db.DisappointmentArchive.select(db.DisappointmentArchive.month)
+    if since is not None:
+        months = months.where(db.DisappointmentArchive.month >= partitions.get_month_start(since.date()))
+    for month in [month for month, in months.order_by(db.DisappointmentArchive.month).tuples()]:
+        content = (db.DisappointmentArchive
+                   .select(db.DisappointmentArchive.content)
+                   .where(db.DisappointmentArchive.month == month)
+                   .scalar())
+        for disappointment in _load_rows(bytes(content)):
+            if since is None or disappointment.created_at >= since:
+                yield disappointment
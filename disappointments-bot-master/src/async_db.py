@@ -0,0 +1,73 @@
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+
+import db
+import settings
+
+T = TypeVar('T')
+
+_executor = ThreadPoolExecutor(
+    max_workers=settings.DB_MAX_CONNECTIONS,
+    thread_name_prefix='db',
+)
+
+
+def _call_with_connection(func: Callable[..., T], *args, **kwargs) -> T:
+    with db.engine.connection_context():
+        return func(*args, **kwargs)
+
+
+async def run_sync(func: Callable[..., T], *args, **kwargs) -> T:
+    """Run blocking database code in the db thread pool with a pooled connection
+
+    The call runs in a copy of the current context, so queries are counted for the update
+    that made them.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, _call_with_connection, func, *args, **kwargs)
+    return await loop.run_in_executor(_executor, call)
+
+
+def _to_async(func: Callable[..., T]) -> Callable[..., Any]:
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs) -> T:
+        return await run_sync(func, *args, **kwargs)
+    return wrapper
+
+
+insert_users = _to_async(db.insert_users)
+import_users = _to_async(db.import_users)
+create_tables = _to_async(db.create_tables)
+add_disappointment_spending_point = _to_async(db.add_disappointment_spending_point)
+reset_user_points = _to_async(db.reset_user_points)
+refresh_users_cache = _to_async(db.refresh_users_cache)
+sync_users_cache = _to_async(db.sync_users_cache)
+get_user_stats = _to_async(db.get_user_stats)
+reconcile_user_stats = _to_async(db.reconcile_user_stats)
+get_statistics = _to_async(db.get_statistics)
+get_disappointment_by_id = _to_async(db.get_disappointment_by_id)
+delete_disappointment_by_id = _to_async(db.delete_disappointment_by_id)
+get_disappointments_data_version = _to_async(db.get_disappointments_data_version)
+get_disappointments_page_from_user = _to_async(db.get_disappointments_page_from_user)
+get_disappointments_page_to_user = _to_async(db.get_disappointments_page_to_user)
+search_disappointments = _to_async(db.search_disappointments)
+get_fsm_record = _to_async(db.get_fsm_record)
+save_fsm_record = _to_async(db.save_fsm_record)
+update_fsm_record_values = _to_async(db.update_fsm_record_values)
+delete_expired_fsm_records = _to_async(db.delete_expired_fsm_records)
+record_processed_update = _to_async(db.record_processed_update)
+delete_expired_processed_updates = _to_async(db.delete_expired_processed_updates)
+
+
+async def maintain_pool() -> None:
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(_executor, db.engine.maintain)
+
+
+def shutdown():
+    _executor.shutdown(wait=True)
+    db.engine.close_all()
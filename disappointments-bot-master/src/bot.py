@@ -1,9 +1,24 @@
 from aiogram import Bot, Dispatcher
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
+from aiogram.dispatcher.storage import BaseStorage
 from aiogram.types import ParseMode
 
 import settings
+from fsm_storage import PostgresStorage
+from middlewares import MetricsMiddleware, UpdatesDeduplicationMiddleware
+
+
+def create_storage() -> BaseStorage:
+    if settings.FSM_STORAGE == 'memory':
+        return MemoryStorage()
+    return PostgresStorage()
 
 
 bot = Bot(settings.TELEGRAM_BOT_TOKEN, parse_mode=ParseMode.MARKDOWN_V2)
-dp = Dispatcher(bot, storage=MemoryStorage())
+dp = Dispatcher(bot, storage=create_storage())
+# Duplicates are dropped before any other middleware sees them
+dp.middleware.setup(UpdatesDeduplicationMiddleware(
+    max_size=settings.UPDATES_DEDUPLICATION_SIZE,
+    ttl=settings.UPDATES_DEDUPLICATION_TTL,
+))
+dp.middleware.setup(MetricsMiddleware())
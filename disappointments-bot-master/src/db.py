@@ -1,30 +1,54 @@
-from datetime import datetime
-from typing import Iterable, TypeAlias
+import json
+from datetime import date, datetime, time, timedelta
+from typing import Iterable, Iterator, NamedTuple, TypeAlias
 
 from peewee import (
-    PostgresqlDatabase,
     Model,
     CharField,
     BigIntegerField,
+    BlobField,
     ForeignKeyField,
-    IntegrityError,
+    DateField,
     DateTimeField,
-    DoesNotExist,
     IntegerField,
+    JOIN,
+    TextField,
+    CompositeKey,
+    Case,
+    ModelSelect,
+    CTE,
+    EXCLUDED,
+    SQL,
+    Expression,
+    Tuple,
+    Select,
+    Value,
+    chunked,
+    fn,
 )
 
 import exceptions
 import settings
-from exceptions import UserDoesNotExist
+from db_pool import HealthCheckedPooledPostgresqlDatabase
+from users_cache import UsersCache
+from search import SearchQuery
+from users_import import UserData, read_users_file
 from utils import logger
 
-engine = PostgresqlDatabase(
+engine = HealthCheckedPooledPostgresqlDatabase(
     database=settings.DATABASE.path.strip('/'),
     password=settings.DATABASE.password,
     user=settings.DATABASE.username,
     host=settings.DATABASE.hostname,
     port=settings.DATABASE.port,
     autorollback=True,
+    min_connections=settings.DB_MIN_CONNECTIONS,
+    max_connections=settings.DB_MAX_CONNECTIONS,
+    idle_timeout=settings.DB_CONNECTION_IDLE_TIMEOUT,
+    stale_timeout=settings.DB_CONNECTION_MAX_AGE,
+    timeout=settings.DB_CONNECTION_WAIT_TIMEOUT,
+    pre_ping=settings.DB_CONNECTION_PRE_PING,
+    slow_query_threshold=settings.DB_SLOW_QUERY_THRESHOLD,
 )
 
 
@@ -37,6 +61,13 @@ class User(BaseModel):
     name = CharField(max_length=255)
     telegram_id = BigIntegerField(unique=True)
     points = IntegerField(default=3)
+    # With the rolling refill points are back to full once this time passes, see get_available_points
+    points_refill_at = DateTimeField(null=True)
+
+    def get_available_points(self) -> int:
+        if self.points_refill_at is not None and self.points_refill_at <= datetime.now():
+            return settings.POINTS_AMOUNT
+        return self.points
 
 
 class Disappointment(BaseModel):
@@ -45,6 +76,81 @@ class Disappointment(BaseModel):
     to_user = ForeignKeyField(User, on_delete='CASCADE')
     created_at = DateTimeField(default=datetime.now)
 
+    class Meta:
+        indexes = (
+            (('from_user', 'created_at', 'id'), False),
+            (('to_user', 'created_at', 'id'), False),
+            (('created_at', 'id'), False),
+        )
+
+
+class UserStats(BaseModel):
+    user = ForeignKeyField(User, primary_key=True, on_delete='CASCADE')
+    received_count = IntegerField(default=0)
+    given_count = IntegerField(default=0)
+    last_received_at = DateTimeField(null=True)
+
+
+class DailyStats(BaseModel):
+    """Disappointments created per day, maintained by disappointment writes"""
+    day = DateField(primary_key=True)
+    disappointments_count = IntegerField(default=0)
+
+
+class DisappointmentArchive(BaseModel):
+    """Disappointments of a month moved out of the disappointments table, gzipped NDJSON rows"""
+    month = DateField(primary_key=True)
+    disappointments_count = IntegerField(default=0)
+    content = BlobField()
+    archived_at = DateTimeField(default=datetime.now)
+
+
+class ArchivedUserStats(BaseModel):
+    """Counters of users' archived disappointments, recounted stats add them to the disappointments left"""
+    user = ForeignKeyField(User, primary_key=True, on_delete='CASCADE')
+    received_count = IntegerField(default=0)
+    given_count = IntegerField(default=0)
+    last_received_at = DateTimeField(null=True)
+
+
+class JobRun(BaseModel):
+    job = CharField(max_length=255)
+    scheduled_at = DateTimeField()
+    finished_at = DateTimeField(default=datetime.now)
+    missed_runs = IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            (('job', 'scheduled_at'), True),
+        )
+
+
+class JSONField(TextField):
+
+    def db_value(self, value):
+        return json.dumps(value)
+
+    def python_value(self, value):
+        return json.loads(value) if value is not None else None
+
+
+class FSMRecord(BaseModel):
+    chat = BigIntegerField()
+    user = BigIntegerField()
+    state = CharField(max_length=255, null=True)
+    data = JSONField(default=dict)
+    bucket = JSONField(default=dict)
+    updated_at = DateTimeField(default=datetime.now, index=True)
+
+    class Meta:
+        primary_key = CompositeKey('chat', 'user')
+
+
+class ProcessedUpdate(BaseModel):
+    """Ids of updates taken for processing, so updates Telegram delivers again after a restart are skipped"""
+    update_id = BigIntegerField(primary_key=True)
+    processed_at = DateTimeField(default=datetime.now, index=True)
+
 
 FromUser = User.alias()
 ToUser = User.alias()
@@ -52,102 +158,827 @@ ToUser = User.alias()
 UserOrId: TypeAlias = User | int | str
 
 
-def get_all_disappointments() -> Iterable[Disappointment]:
-    return (Disappointment.select(Disappointment, FromUser, ToUser)
+class DisappointmentRow(NamedTuple):
+    """Read-only projection of a disappointment with the names its views and exports show"""
+    id: int
+    reason: str
+    created_at: datetime
+    from_user_name: str
+    to_user_name: str
+    to_user_telegram_id: int
+
+
+class PageCursor(NamedTuple):
+    created_at: datetime
+    id: int
+
+
+class DisappointmentsPage(NamedTuple):
+    disappointments: list[DisappointmentRow]
+    has_previous: bool
+    has_next: bool
+
+
+class LeaderboardRow(NamedTuple):
+    name: str
+    count: int
+
+
+class TrendRow(NamedTuple):
+    period_start: date
+    count: int
+
+
+class Statistics(NamedTuple):
+    received_leaderboard: list[LeaderboardRow]
+    given_leaderboard: list[LeaderboardRow]
+    daily_trend: list[TrendRow]
+    weekly_trend: list[TrendRow]
+
+
+class SearchPage(NamedTuple):
+    disappointments: list[DisappointmentRow]
+    offset: int
+    has_next: bool
+
+
+class DataVersion(NamedTuple):
+    max_id: int
+    changes_counter: int
+
+
+# The search index is built over to_tsvector of reasons with this config, see migrations
+SEARCH_TEXT_CONFIG = 'simple'
+# Sequences counting changes of the data cached by every process, see migrations
+USERS_CHANGES_SEQUENCE = 'users_changes'
+DISAPPOINTMENTS_CHANGES_SEQUENCE = 'disappointments_changes'
+
+users_cache = UsersCache()
+
+# Users changes counter the users cache was loaded at
+_users_cache_changes_counter: int | None = None
+
+
+def _select_disappointments() -> ModelSelect:
+    """Select only the columns of ``DisappointmentRow``, in its order"""
+    return (Disappointment
+            .select(
+                Disappointment.id,
+                Disappointment.reason,
+                Disappointment.created_at,
+                FromUser.name,
+                ToUser.name,
+                ToUser.telegram_id,
+            )
             .join(FromUser, on=(Disappointment.from_user == FromUser.id))
             .switch(Disappointment)
-            .join(ToUser, on=(Disappointment.to_user == ToUser.id))
-            .execute())
+            .join(ToUser, on=(Disappointment.to_user == ToUser.id)))
+
+
+def _fetch_rows(query: ModelSelect) -> list[DisappointmentRow]:
+    return [DisappointmentRow._make(row) for row in query.tuples().iterator()]
+
+
+def iter_disappointments(
+        since: datetime | None = None,
+        until: datetime | None = None,
+        chunk_size: int = settings.EXPORT_CHUNK_SIZE,
+) -> Iterator[DisappointmentRow]:
+    """Iterate over disappointments created since ``since`` and before ``until`` in chunks of ``chunk_size`` rows
+
+    Chunks are fetched by ``(created_at, id)`` keyset, so the period filter and every chunk
+    are served by the ``(created_at, id)`` index.
+    """
+    key = Tuple(Disappointment.created_at, Disappointment.id)
+    query = _select_disappointments().order_by(Disappointment.created_at.asc(), Disappointment.id.asc())
+    if since is not None:
+        query = query.where(Disappointment.created_at >= since)
+    if until is not None:
+        query = query.where(Disappointment.created_at < until)
+    last_key = None
+    while True:
+        chunk_query = query if last_key is None else query.where(key > last_key)
+        chunk = _fetch_rows(chunk_query.limit(chunk_size))
+        yield from chunk
+        if len(chunk) < chunk_size:
+            return
+        last_key = (chunk[-1].created_at, chunk[-1].id)
+
+
+DEFAULT_USERS = (
+    UserData('Dinaiym', 5093311685),
+    UserData('Eldos', 896678539),
+    UserData('Rustam', 756995300),
+)
 
 
 def insert_users():
-    users_data = (
-        ('Dinaiym', 5093311685,),
-        ('Eldos', 896678539,),
-        ('Rustam', 756995300,),
-    )
-    for name, telegram_id in users_data:
-        try:
-            User.create(name=name, telegram_id=telegram_id)
-            logger.debug(f'Name: {name} Telegram ID {telegram_id} created.')
-        except IntegrityError:
-            logger.debug(f'Name: {name} Telegram ID {telegram_id} already exists in DB.')
+    """Provision users from ``USERS_FILE``, or the default ones if it is not set"""
+    users = DEFAULT_USERS
+    if settings.USERS_FILE is not None:
+        users = read_users_file(settings.USERS_FILE)
+    created_users_count = import_users(users, update_names=False)
+    logger.debug(f'{created_users_count} users created')
+
+
+def import_users(
+        users: Iterable[UserData],
+        update_names: bool = True,
+        batch_size: int = settings.USERS_IMPORT_BATCH_SIZE,
+) -> int:
+    """Upsert users by telegram id with one statement per batch and reload the users cache
+
+    Return the number of created users plus, with ``update_names``, the number of renamed ones.
+    """
+    # Postgres can't update the same row twice in one statement, so the last duplicate wins
+    rows = list({
+        user.telegram_id: {'name': user.name, 'telegram_id': user.telegram_id}
+        for user in users
+    }.values())
+    changed_users_count = 0
+    with engine.atomic():
+        for batch in chunked(rows, batch_size):
+            query = User.insert_many(batch)
+            if update_names:
+                query = query.on_conflict(
+                    conflict_target=(User.telegram_id,),
+                    update={User.name: EXCLUDED.name},
+                    where=(User.name != EXCLUDED.name),
+                )
+            else:
+                query = query.on_conflict_ignore()
+            changed_users_count += len(list(query.returning(User.id).execute()))
+    if changed_users_count:
+        # Other processes reload their users caches on the next sync
+        _bump_users_changes_counter()
+    refresh_users_cache()
+    return changed_users_count
 
 
 def create_tables():
     tables = (
         User,
         Disappointment,
+        UserStats,
+        DailyStats,
+        DisappointmentArchive,
+        ArchivedUserStats,
+        FSMRecord,
+        JobRun,
+        ProcessedUpdate,
     )
-    engine.create_tables(tables)
+    engine.create_tables(table for table in tables if not table.table_exists())
     logger.debug('Tables created')
 
 
-def add_disappointment(from_user: User, to_user: User, reason: str) -> Disappointment:
-    return Disappointment.create(
+def _bump_changes_counter(sequence: str) -> None:
+    """Count a committed change, so every process sees its cached data is stale
+
+    Sequences are not transactional, the counter is bumped after the change is committed,
+    otherwise a process could cache the data without the change at the new counter.
+    """
+    engine.execute_sql('SELECT nextval(%s)', (sequence,))
+
+
+def _get_changes_counter(sequence: str) -> int:
+    return engine.execute_sql(f'SELECT last_value FROM "{sequence}"').fetchone()[0]
+
+
+def _bump_disappointments_changes_counter() -> None:
+    _bump_changes_counter(DISAPPOINTMENTS_CHANGES_SEQUENCE)
+
+
+def _bump_users_changes_counter() -> None:
+    _bump_changes_counter(USERS_CHANGES_SEQUENCE)
+
+
+def get_disappointments_data_version() -> DataVersion:
+    """Version of the disappointments table, it changes after every insert or delete in any process"""
+    max_id = Disappointment.select(fn.MAX(Disappointment.id)).scalar() or 0
+    return DataVersion(max_id=max_id, changes_counter=_get_changes_counter(DISAPPOINTMENTS_CHANGES_SEQUENCE))
+
+
+def _count_in_user_stats(
+        inserted_disappointment: CTE,
+        from_user_id: int,
+        to_user_id: int,
+        created_at: datetime,
+) -> list[CTE]:
+    """Upserts counting the disappointment in users stats if ``inserted_disappointment`` returns a row
+
+    Users are upserted by separate statements, a user disappointed by themselves gets
+    a single row, because Postgres can't modify the same row twice in one statement.
+    """
+    if from_user_id == to_user_id:
+        changes = ((from_user_id, 1, 1, created_at),)
+    else:
+        changes = ((from_user_id, 0, 1, None), (to_user_id, 1, 0, created_at))
+    upserts = []
+    for number, (user_id, received_count, given_count, last_received_at) in enumerate(changes):
+        upsert = (UserStats
+                  .insert_from(
+                      inserted_disappointment.select(
+                          Value(user_id),
+                          Value(received_count),
+                          Value(given_count),
+                          Value(last_received_at),
+                      ),
+                      fields=(
+                          UserStats.user,
+                          UserStats.received_count,
+                          UserStats.given_count,
+                          UserStats.last_received_at,
+                      ),
+                  )
+                  .on_conflict(
+                      conflict_target=(UserStats.user,),
+                      update={
+                          UserStats.received_count: UserStats.received_count + EXCLUDED.received_count,
+                          UserStats.given_count: UserStats.given_count + EXCLUDED.given_count,
+                          UserStats.last_received_at: fn.GREATEST(
+                              UserStats.last_received_at,
+                              EXCLUDED.last_received_at,
+                          ),
+                      },
+                  )
+                  .returning(UserStats.user)
+                  .cte(f'counted_user_stats_{number}'))
+        upserts.append(upsert)
+    return upserts
+
+
+def _count_in_daily_stats(inserted_disappointment: CTE, created_at: datetime) -> CTE:
+    """Upsert counting the disappointment in its day if ``inserted_disappointment`` returns a row"""
+    return (DailyStats
+            .insert_from(
+                inserted_disappointment.select(Value(created_at.date()), Value(1)),
+                fields=(DailyStats.day, DailyStats.disappointments_count),
+            )
+            .on_conflict(
+                conflict_target=(DailyStats.day,),
+                update={
+                    DailyStats.disappointments_count: (
+                        DailyStats.disappointments_count + EXCLUDED.disappointments_count
+                    ),
+                },
+            )
+            .returning(DailyStats.day)
+            .cte('counted_daily_stats'))
+
+
+def _insert_disappointment_from(
+        source: CTE,
+        from_user: User,
+        to_user: User,
+        reason: str,
+        created_at: datetime,
+) -> CTE:
+    values = (Value(from_user.id), Value(to_user.id), Value(reason), Value(created_at))
+    fields = (
+        Disappointment.from_user,
+        Disappointment.to_user,
+        Disappointment.reason,
+        Disappointment.created_at,
+    )
+    return (Disappointment
+            .insert_from(source.select(*values), fields=fields)
+            .returning(Disappointment.id)
+            .cte('inserted_disappointment'))
+
+
+def _spend_point(user_id: int, now: datetime):
+    """Update taking one point from the user if they have any
+
+    With the rolling refill points that are due are restored first, and the first point spent
+    after a refill schedules the next one in ``POINTS_REFILL_HOURS``.
+    """
+    available_points = Case(None, ((User.points_refill_at <= now, settings.POINTS_AMOUNT),), User.points)
+    values = {User.points: available_points - 1}
+    if settings.POINTS_REFILL_MODE == 'rolling':
+        is_refill_due = User.points_refill_at.is_null() | (User.points_refill_at <= now)
+        next_refill_at = now + timedelta(hours=settings.POINTS_REFILL_HOURS)
+        values[User.points_refill_at] = Case(None, ((is_refill_due, next_refill_at),), User.points_refill_at)
+    return (User
+            .update(values)
+            .where((User.id == user_id) & (available_points > 0)))
+
+
+def add_disappointment_spending_point(
+        from_user: User,
+        to_user: User,
+        reason: str,
+) -> Disappointment:
+    """Take one point from ``from_user`` and add the disappointment in a single statement
+
+    The conditional update, the insert and the stats upserts are chained with CTEs,
+    so they run in one transaction and one round-trip, and concurrent calls can't spend
+    more points than the user has.
+    """
+    created_at = datetime.now()
+    spent_point = (_spend_point(from_user.id, created_at)
+                   .returning(User.id, User.points, User.points_refill_at)
+                   .cte('spent_point'))
+    inserted_disappointment = _insert_disappointment_from(
+        spent_point,
+        from_user,
+        to_user,
+        reason,
+        created_at,
+    )
+    user_stats_upserts = _count_in_user_stats(
+        inserted_disappointment,
+        from_user.id,
+        to_user.id,
+        created_at,
+    )
+    daily_stats_upsert = _count_in_daily_stats(inserted_disappointment, created_at)
+    query = (Select(from_list=(inserted_disappointment, spent_point),
+                    columns=(
+                        inserted_disappointment.c.id,
+                        spent_point.c.points,
+                        spent_point.c.points_refill_at,
+                    ))
+             .with_cte(spent_point, inserted_disappointment, *user_stats_upserts, daily_stats_upsert)
+             .bind(engine))
+    row = query.tuples().first()
+    if row is None:
+        raise exceptions.UserHasNotEnoughPoints
+    disappointment_id, points_left, points_refill_at = row
+    users_cache.set_points(from_user.id, points_left, points_refill_at)
+    _bump_disappointments_changes_counter()
+    return Disappointment(
+        id=disappointment_id,
         from_user=from_user,
         to_user=to_user,
         reason=reason,
+        created_at=created_at,
     )
 
 
-def get_user_by_telegram_id(telegram_id: int) -> User:
-    try:
-        return User.get(telegram_id=telegram_id)
-    except DoesNotExist:
-        raise UserDoesNotExist
-
-
 def get_all_users() -> Iterable[User]:
     return User.select().execute()
 
 
-def get_user_by_id(user_id: int) -> User:
-    try:
-        return User.get_by_id(user_id)
-    except DoesNotExist:
-        raise UserDoesNotExist
+def reset_user_points():
+    updated_users = (User
+                     .update(points=settings.POINTS_AMOUNT, points_refill_at=None)
+                     .returning(User.id, User.points)
+                     .tuples()
+                     .execute())
+    for user_id, points in updated_users:
+        users_cache.set_points(user_id, points)
 
 
-def reset_user_points():
-    User.update(points=settings.POINTS_AMOUNT).execute()
+def try_advisory_lock(key: int) -> bool:
+    return engine.execute_sql('SELECT pg_try_advisory_lock(%s)', (key,)).fetchone()[0]
+
+
+def advisory_lock(key: int) -> None:
+    engine.execute_sql('SELECT pg_advisory_lock(%s)', (key,))
+
+
+def advisory_unlock(key: int) -> None:
+    engine.execute_sql('SELECT pg_advisory_unlock(%s)', (key,))
+
 
+def get_last_job_run(job: str) -> JobRun | None:
+    return (JobRun.select()
+            .where(JobRun.job == job)
+            .order_by(JobRun.scheduled_at.desc())
+            .first())
 
-def get_user_disappointments_amount(user: User) -> int:
-    return Disappointment.select().where(Disappointment.to_user == user).count()
 
+def save_job_run(job: str, scheduled_at: datetime, missed_runs: int) -> JobRun:
+    return JobRun.create(job=job, scheduled_at=scheduled_at, missed_runs=missed_runs)
 
-def get_disappointment_by_id(disappointment_id: int | str) -> Disappointment:
-    try:
-        return (Disappointment.select(Disappointment, FromUser, ToUser)
-                .join(FromUser, on=(Disappointment.from_user == FromUser.id))
-                .switch(Disappointment)
-                .join(ToUser, on=(Disappointment.to_user == ToUser.id))
-                .where(Disappointment.id == disappointment_id)
-                .get())
-    except DoesNotExist:
+
+def refresh_users_cache() -> None:
+    global _users_cache_changes_counter
+    # Read before the users, so a change made in between reloads the cache on the next sync
+    changes_counter = _get_changes_counter(USERS_CHANGES_SEQUENCE)
+    users_cache.load(get_all_users())
+    _users_cache_changes_counter = changes_counter
+    logger.debug('Users cached')
+
+
+def sync_users_cache() -> bool:
+    """Reload the users cache if users were changed since it was loaded, by any process"""
+    if _get_changes_counter(USERS_CHANGES_SEQUENCE) == _users_cache_changes_counter:
+        return False
+    refresh_users_cache()
+    return True
+
+
+def get_user_stats(user_id: int) -> UserStats:
+    """Counters maintained by disappointment writes, zeros for users without a stats row yet"""
+    user_stats = UserStats.get_or_none(UserStats.user == user_id)
+    if user_stats is None:
+        return UserStats(user=user_id)
+    return user_stats
+
+
+def recount_user_stats(user_ids: Iterable[int] | None = None) -> int:
+    """Recount stats of the users or of all users, return the number of changed rows
+
+    Disappointments are counted together with the archived stats of the users.
+    """
+    received = Disappointment.alias()
+    given = Disappointment.alias()
+    # The column goes first, a query on the left of + is a UNION ALL to peewee
+    received_count = (fn.COALESCE(ArchivedUserStats.received_count, 0)
+                      + received.select(fn.COUNT(received.id)).where(received.to_user == User.id))
+    given_count = (fn.COALESCE(ArchivedUserStats.given_count, 0)
+                   + given.select(fn.COUNT(given.id)).where(given.from_user == User.id))
+    # Archived months are older than any disappointment left
+    last_received_at = fn.COALESCE(
+        received.select(fn.MAX(received.created_at)).where(received.to_user == User.id),
+        ArchivedUserStats.last_received_at,
+    )
+    fields = (
+        UserStats.user,
+        UserStats.received_count,
+        UserStats.given_count,
+        UserStats.last_received_at,
+    )
+    stored = Tuple(*fields[1:])
+    recounted = Tuple(*(getattr(EXCLUDED, field.column_name) for field in fields[1:]))
+    stored_stats = UserStats.alias()
+    has_stats = fn.EXISTS(stored_stats.select(SQL('1')).where(stored_stats.user == User.id))
+    # Users with neither a stats row nor disappointments have nothing to recount
+    users = (User
+             .select(User.id, received_count, given_count, last_received_at)
+             .join(ArchivedUserStats, JOIN.LEFT_OUTER, on=(ArchivedUserStats.user == User.id))
+             .where(has_stats | (received_count > 0) | (given_count > 0)))
+    if user_ids is not None:
+        users = users.where(User.id.in_(list(user_ids)))
+    query = (UserStats
+             .insert_from(users, fields)
+             .on_conflict(
+                 conflict_target=(UserStats.user,),
+                 update={field: getattr(EXCLUDED, field.column_name) for field in fields[1:]},
+                 where=Expression(stored, 'IS DISTINCT FROM', recounted),
+             )
+             .returning(UserStats.user))
+    return len(list(query.execute()))
+
+
+def archive_user_stats(since: datetime, until: datetime) -> int:
+    """Add disappointments of the period to the archived stats of their users, return the number of users
+
+    Called before the period's disappointments are archived, so user stats keep counting them.
+    """
+    def in_period(disappointment: type[Disappointment]) -> Expression:
+        return (disappointment.created_at >= since) & (disappointment.created_at < until)
+
+    received = Disappointment.alias()
+    given = Disappointment.alias()
+    received_count = (received
+                      .select(fn.COUNT(received.id))
+                      .where((received.to_user == User.id) & in_period(received)))
+    given_count = (given
+                   .select(fn.COUNT(given.id))
+                   .where((given.from_user == User.id) & in_period(given)))
+    last_received_at = (received
+                        .select(fn.MAX(received.created_at))
+                        .where((received.to_user == User.id) & in_period(received)))
+    users = (User
+             .select(User.id, received_count, given_count, last_received_at)
+             .where((received_count > 0) | (given_count > 0)))
+    query = (ArchivedUserStats
+             .insert_from(users, fields=(
+                 ArchivedUserStats.user,
+                 ArchivedUserStats.received_count,
+                 ArchivedUserStats.given_count,
+                 ArchivedUserStats.last_received_at,
+             ))
+             .on_conflict(
+                 conflict_target=(ArchivedUserStats.user,),
+                 update={
+                     ArchivedUserStats.received_count: (
+                         ArchivedUserStats.received_count + EXCLUDED.received_count
+                     ),
+                     ArchivedUserStats.given_count: ArchivedUserStats.given_count + EXCLUDED.given_count,
+                     ArchivedUserStats.last_received_at: fn.GREATEST(
+                         ArchivedUserStats.last_received_at,
+                         EXCLUDED.last_received_at,
+                     ),
+                 },
+             )
+             .returning(ArchivedUserStats.user))
+    return len(list(query.execute()))
+
+
+def reconcile_user_stats() -> int:
+    """Recount stats of all users, counters maintained by writes should never need fixing"""
+    fixed_rows_count = recount_user_stats()
+    if fixed_rows_count:
+        logger.warning(f'User stats of {fixed_rows_count} users were reconciled')
+    return fixed_rows_count
+
+
+def reconcile_daily_stats(days: int | None = settings.DAILY_STATS_RECONCILE_DAYS) -> int:
+    """Recount daily stats of the last ``days`` days or of all days, return the number of fixed rows
+
+    Only the recent days are recounted by default, so the recount reads a range of
+    the ``created_at`` index instead of the whole history. Days of archived months keep their counts.
+    """
+    day = Disappointment.created_at.cast('date')
+    recounted = Disappointment.select(day, fn.COUNT(Disappointment.id)).group_by(day)
+    same_day = Disappointment.alias()
+    has_disappointments = fn.EXISTS(
+        same_day
+        .select(SQL('1'))
+        .where((same_day.created_at >= DailyStats.day)
+               & (same_day.created_at < DailyStats.day + SQL("interval '1 day'")))
+    )
+    is_archived = fn.EXISTS(
+        DisappointmentArchive
+        .select(SQL('1'))
+        .where(DisappointmentArchive.month == fn.DATE_TRUNC('month', DailyStats.day).cast('date'))
+    )
+    emptied_days = (DailyStats.disappointments_count != 0) & ~has_disappointments & ~is_archived
+    if days is not None:
+        since = date.today() - timedelta(days=days)
+        recounted = recounted.where(Disappointment.created_at >= datetime.combine(since, time()))
+        emptied_days &= DailyStats.day >= since
+    with engine.atomic():
+        upserted_days = (DailyStats
+                         .insert_from(recounted, fields=(DailyStats.day, DailyStats.disappointments_count))
+                         .on_conflict(
+                             conflict_target=(DailyStats.day,),
+                             update={DailyStats.disappointments_count: EXCLUDED.disappointments_count},
+                             where=DailyStats.disappointments_count != EXCLUDED.disappointments_count,
+                         )
+                         .returning(DailyStats.day)
+                         .execute())
+        fixed_rows_count = len(list(upserted_days))
+        fixed_rows_count += (DailyStats
+                             .update(disappointments_count=0)
+                             .where(emptied_days)
+                             .execute())
+    if fixed_rows_count:
+        logger.warning(f'Daily stats of {fixed_rows_count} days were reconciled')
+    return fixed_rows_count
+
+
+def _get_leaderboard(count_field: IntegerField, size: int) -> list[LeaderboardRow]:
+    query = (UserStats
+             .select(User.name, count_field)
+             .join(User)
+             .where(count_field > 0)
+             .order_by(count_field.desc(), User.name)
+             .limit(size))
+    return [LeaderboardRow._make(row) for row in query.tuples()]
+
+
+def _get_trend(
+        daily_counts: dict[date, int],
+        period_starts: Iterable[date],
+        period_days: int,
+) -> list[TrendRow]:
+    return [
+        TrendRow(
+            period_start=period_start,
+            count=sum(daily_counts.get(period_start + timedelta(days=day), 0) for day in range(period_days)),
+        )
+        for period_start in period_starts
+    ]
+
+
+def get_statistics(
+        leaderboard_size: int = settings.STATS_LEADERBOARD_SIZE,
+        days: int = settings.STATS_TREND_DAYS,
+        weeks: int = settings.STATS_TREND_WEEKS,
+) -> Statistics:
+    """Leaderboards and trends read from users and daily stats, never from disappointments"""
+    today = date.today()
+    first_week_start = today - timedelta(days=today.weekday(), weeks=weeks - 1)
+    first_day = today - timedelta(days=days - 1)
+    daily_counts = dict(DailyStats
+                        .select(DailyStats.day, DailyStats.disappointments_count)
+                        .where(DailyStats.day >= min(first_day, first_week_start))
+                        .tuples())
+    return Statistics(
+        received_leaderboard=_get_leaderboard(UserStats.received_count, leaderboard_size),
+        given_leaderboard=_get_leaderboard(UserStats.given_count, leaderboard_size),
+        daily_trend=_get_trend(
+            daily_counts,
+            (first_day + timedelta(days=number) for number in range(days)),
+            period_days=1,
+        ),
+        weekly_trend=_get_trend(
+            daily_counts,
+            (first_week_start + timedelta(weeks=number) for number in range(weeks)),
+            period_days=7,
+        ),
+    )
+
+
+def get_disappointment_by_id(disappointment_id: int | str) -> DisappointmentRow:
+    rows = _fetch_rows(_select_disappointments().where(Disappointment.id == disappointment_id))
+    if not rows:
         raise exceptions.DisappointmentDoesNotExist
+    return rows[0]
 
 
 def delete_disappointment_by_id(pk: int | str) -> int:
-    return Disappointment.delete_by_id(pk)
+    """Delete the disappointment and uncount it from users and daily stats in a single statement"""
+    deleted_disappointment = (Disappointment
+                              .delete()
+                              .where(Disappointment.id == pk)
+                              .returning(
+                                  Disappointment.id,
+                                  Disappointment.from_user,
+                                  Disappointment.to_user,
+                                  Disappointment.created_at,
+                              )
+                              .cte('deleted_disappointment'))
+    from_user_id = deleted_disappointment.c.from_user_id
+    to_user_id = deleted_disappointment.c.to_user_id
+    # Statements of a WITH query see the same snapshot, so the deleted row is excluded explicitly
+    received = Disappointment.alias()
+    archived_last_received_at = (ArchivedUserStats
+                                 .select(ArchivedUserStats.last_received_at)
+                                 .where(ArchivedUserStats.user == UserStats.user))
+    last_received_at = (received
+                        .select(fn.COALESCE(fn.MAX(received.created_at), archived_last_received_at))
+                        .where((received.to_user == UserStats.user)
+                               & (received.id != deleted_disappointment.c.id)))
+    uncounted_user_stats = (UserStats
+                            .update(
+                                received_count=UserStats.received_count - Case(
+                                    None, ((UserStats.user == to_user_id, 1),), 0,
+                                ),
+                                given_count=UserStats.given_count - Case(
+                                    None, ((UserStats.user == from_user_id, 1),), 0,
+                                ),
+                                # Recounting it for the other user too keeps the same value
+                                last_received_at=last_received_at,
+                            )
+                            .from_(deleted_disappointment)
+                            .where(UserStats.user.in_((from_user_id, to_user_id)))
+                            .returning(UserStats.user)
+                            .cte('uncounted_user_stats'))
+    uncounted_daily_stats = (DailyStats
+                             .update(disappointments_count=DailyStats.disappointments_count - 1)
+                             .from_(deleted_disappointment)
+                             .where(DailyStats.day == deleted_disappointment.c.created_at.cast('date'))
+                             .returning(DailyStats.day)
+                             .cte('uncounted_daily_stats'))
+    query = (deleted_disappointment
+             .select_from(fn.COUNT(SQL('*')))
+             .with_cte(deleted_disappointment, uncounted_user_stats, uncounted_daily_stats)
+             .bind(engine))
+    deleted_rows_count = query.scalar()
+    if deleted_rows_count:
+        _bump_disappointments_changes_counter()
+    return deleted_rows_count
+
+
+def _get_disappointments_page(
+        condition: Expression,
+        cursor: PageCursor | None,
+        backward: bool,
+        page_size: int,
+) -> DisappointmentsPage:
+    """Page of disappointments ordered by ``(created_at, id)``, next to the ``cursor`` row
+
+    Pages are fetched by keyset, so every page costs the same indexed query however deep it is.
+    """
+    key = Tuple(Disappointment.created_at, Disappointment.id)
+    query = _select_disappointments().where(condition)
+    if backward:
+        if cursor is not None:
+            query = query.where(key < tuple(cursor))
+        query = query.order_by(Disappointment.created_at.desc(), Disappointment.id.desc())
+    else:
+        if cursor is not None:
+            query = query.where(key > tuple(cursor))
+        query = query.order_by(Disappointment.created_at.asc(), Disappointment.id.asc())
+    disappointments = _fetch_rows(query.limit(page_size + 1))
+    has_more = len(disappointments) > page_size
+    disappointments = disappointments[:page_size]
+    if backward:
+        disappointments.reverse()
+        return DisappointmentsPage(disappointments, has_previous=has_more, has_next=cursor is not None)
+    return DisappointmentsPage(disappointments, has_previous=cursor is not None, has_next=has_more)
+
+
+def get_disappointments_page_from_user(
+        user_id: int,
+        cursor: PageCursor | None = None,
+        backward: bool = False,
+        page_size: int = settings.DISAPPOINTMENTS_PAGE_SIZE,
+) -> DisappointmentsPage:
+    return _get_disappointments_page(Disappointment.from_user == user_id, cursor, backward, page_size)
+
+
+def get_disappointments_page_to_user(
+        user_id: int,
+        cursor: PageCursor | None = None,
+        backward: bool = False,
+        page_size: int = settings.DISAPPOINTMENTS_PAGE_SIZE,
+) -> DisappointmentsPage:
+    return _get_disappointments_page(Disappointment.to_user == user_id, cursor, backward, page_size)
+
+
+def search_disappointments(
+        query: SearchQuery,
+        offset: int = 0,
+        page_size: int = settings.SEARCH_PAGE_SIZE,
+) -> SearchPage:
+    """Disappointments matching the query, best matching first, newest first without words to match
+
+    Words are matched by the full-text index over reasons, the filters are applied by the same query.
+    """
+    select = _select_disappointments()
+    if query.from_user_id is not None:
+        select = select.where(Disappointment.from_user == query.from_user_id)
+    if query.to_user_id is not None:
+        select = select.where(Disappointment.to_user == query.to_user_id)
+    if query.since is not None:
+        select = select.where(Disappointment.created_at >= query.since)
+    if query.until is not None:
+        select = select.where(Disappointment.created_at < query.until)
+    newest_first = (Disappointment.created_at.desc(), Disappointment.id.desc())
+    if query.text:
+        document = fn.to_tsvector(SEARCH_TEXT_CONFIG, Disappointment.reason)
+        text_query = fn.websearch_to_tsquery(SEARCH_TEXT_CONFIG, query.text)
+        select = (select
+                  .where(Expression(document, '@@', text_query))
+                  .order_by(fn.ts_rank(document, text_query).desc(), *newest_first))
+    else:
+        select = select.order_by(*newest_first)
+    disappointments = _fetch_rows(select.offset(offset).limit(page_size + 1))
+    return SearchPage(
+        disappointments=disappointments[:page_size],
+        offset=offset,
+        has_next=len(disappointments) > page_size,
+    )
 
 
-def get_disappointments_from_user_by_telegram_id(
-        telegram_id: int | str,
-) -> Iterable[Disappointment]:
-    return (Disappointment.select(Disappointment, FromUser, ToUser)
-            .join(FromUser, on=(Disappointment.from_user == FromUser.id))
-            .switch(Disappointment)
-            .join(ToUser, on=(Disappointment.to_user == ToUser.id))
-            .where(FromUser.telegram_id == telegram_id)
-            .order_by(Disappointment.created_at.asc())
+def _get_fsm_records_expiration_time() -> datetime:
+    return datetime.now() - timedelta(seconds=settings.FSM_STATE_TTL)
+
+
+def get_fsm_record(chat: int, user: int) -> FSMRecord | None:
+    return (FSMRecord.select()
+            .where((FSMRecord.chat == chat)
+                   & (FSMRecord.user == user)
+                   & (FSMRecord.updated_at > _get_fsm_records_expiration_time()))
+            .first())
+
+
+def save_fsm_record(chat: int, user: int, **values) -> None:
+    """Insert or update the record, fields of an expired record that are not passed are reset"""
+    is_expired = FSMRecord.updated_at <= _get_fsm_records_expiration_time()
+    update = {
+        field: Case(None, ((is_expired, field.db_value(field.default())),), field)
+        for field in (FSMRecord.data, FSMRecord.bucket)
+    }
+    update[FSMRecord.state] = Case(None, ((is_expired, None),), FSMRecord.state)
+    update |= {getattr(FSMRecord, name): value for name, value in values.items()}
+    update[FSMRecord.updated_at] = datetime.now()
+    (FSMRecord
+     .insert(chat=chat, user=user, updated_at=datetime.now(), **values)
+     .on_conflict(conflict_target=(FSMRecord.chat, FSMRecord.user), update=update)
+     .execute())
+
+
+def update_fsm_record_values(chat: int, user: int, field_name: str, values: dict) -> None:
+    """Merge ``values`` into the ``data`` or ``bucket`` of the record under a row lock"""
+    with engine.atomic():
+        record = (FSMRecord.select()
+                  .where((FSMRecord.chat == chat) & (FSMRecord.user == user))
+                  .for_update()
+                  .first())
+        current_values = {}
+        if record is not None and record.updated_at > _get_fsm_records_expiration_time():
+            current_values = getattr(record, field_name)
+        save_fsm_record(chat, user, **{field_name: current_values | values})
+
+
+def record_processed_update(update_id: int) -> bool:
+    """Remember the update, return False if any process has taken it for processing already"""
+    inserted = (ProcessedUpdate
+                .insert(update_id=update_id)
+                .on_conflict_ignore()
+                .returning(ProcessedUpdate.update_id)
+                .execute())
+    return bool(list(inserted))
+
+
+def delete_expired_processed_updates() -> int:
+    expiration_time = datetime.now() - timedelta(seconds=settings.UPDATES_DEDUPLICATION_TTL)
+    return (ProcessedUpdate
+            .delete()
+            .where(ProcessedUpdate.processed_at <= expiration_time)
             .execute())
 
 
-ALL_USER_TELEGRAM_IDS = set()
+def delete_expired_fsm_records() -> int:
+    return (FSMRecord
+            .delete()
+            .where(FSMRecord.updated_at <= _get_fsm_records_expiration_time())
+            .execute())
 
-if not ALL_USER_TELEGRAM_IDS:
-    users = get_all_users()
-    ALL_USER_TELEGRAM_IDS |= {user.telegram_id for user in users}
-    logger.debug('User telegram ids cached')
@@ -0,0 +1,190 @@
+import heapq
+import threading
+import time
+from typing import NamedTuple
+
+import psycopg2
+from playhouse.pool import PooledDatabase, PooledPostgresqlDatabase, MaxConnectionsExceeded, _sentinel
+
+import metrics
+from utils import logger
+
+
+class PoolStats(NamedTuple):
+    max_connections: int
+    idle: int
+    checked_out: int
+    waiting: int
+    reconnects: int
+
+
+class HealthCheckedPooledPostgresqlDatabase(PooledPostgresqlDatabase):
+    """Connection pool with a minimum size, idle timeout and pre-ping on checkout
+
+    The maximum connection age is peewee's ``stale_timeout``, the time to wait for
+    a free connection is peewee's ``timeout``.
+    """
+
+    def __init__(
+            self,
+            database,
+            min_connections: int = 0,
+            idle_timeout: float | None = None,
+            pre_ping: bool = True,
+            slow_query_threshold: float | None = None,
+            **kwargs,
+    ):
+        self._slow_query_threshold = slow_query_threshold
+        self._min_connections = min_connections
+        self._idle_timeout = idle_timeout
+        self._pre_ping = pre_ping
+        self._last_used = {}
+        self._stats_lock = threading.Lock()
+        self._waiting = 0
+        self._reconnects = 0
+        # Keys of connections taken from the pool that are to be pinged once checked out
+        self._pending_pings = set()
+        super().__init__(database, **kwargs)
+
+    def connect(self, reuse_if_open=False):
+        while True:
+            opened = self._check_out(reuse_if_open)
+            # Pinged after peewee's locks are released, a ping under them would serialize
+            # every checkout of every thread behind a round-trip to the database
+            conn = self._state.conn
+            if not opened or not self._take_pending_ping(conn) or self._ping(conn):
+                return opened
+            logger.warning('Pooled connection failed pre-ping, reconnecting')
+            self._add_reconnect()
+            self.manual_close()
+
+    def _check_out(self, reuse_if_open: bool) -> bool:
+        expires = time.monotonic() + (self._wait_timeout or 0)
+        is_waiting = False
+        try:
+            while True:
+                try:
+                    return super(PooledDatabase, self).connect(reuse_if_open)
+                except MaxConnectionsExceeded:
+                    if time.monotonic() >= expires:
+                        raise
+                    if not is_waiting:
+                        is_waiting = True
+                        self._add_waiting(1)
+                    time.sleep(0.05)
+        finally:
+            if is_waiting:
+                self._add_waiting(-1)
+
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        started_at = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params, *args, **kwargs)
+        finally:
+            duration = time.perf_counter() - started_at
+            metrics.observe_db_query(duration)
+            if self._slow_query_threshold is not None and duration > self._slow_query_threshold:
+                logger.warning(f'Slow query took {duration:.3f}s: {sql}')
+
+    def _add_waiting(self, amount: int) -> None:
+        with self._stats_lock:
+            self._waiting += amount
+
+    def _add_reconnect(self) -> None:
+        with self._stats_lock:
+            self._reconnects += 1
+
+    def _is_closed(self, conn) -> bool:
+        """Cheap checks of a pooled connection, run by peewee under the pool lock"""
+        last_used = self._last_used.pop(self.conn_key(conn), None)
+        if super()._is_closed(conn):
+            self._add_reconnect()
+            return True
+        if self._is_idle_expired(last_used):
+            logger.debug(f'Closing connection idle for more than {self._idle_timeout} seconds')
+            conn.close()
+            return True
+        if self._pre_ping:
+            self._pending_pings.add(self.conn_key(conn))
+        return False
+
+    def _take_pending_ping(self, conn) -> bool:
+        with self._pool_lock:
+            key = self.conn_key(conn)
+            is_pending = key in self._pending_pings
+            self._pending_pings.discard(key)
+            return is_pending
+
+    def _is_idle_expired(self, last_used: float | None) -> bool:
+        return (self._idle_timeout is not None
+                and last_used is not None
+                and time.time() - last_used > self._idle_timeout)
+
+    @staticmethod
+    def _ping(conn) -> bool:
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            if not conn.autocommit:
+                conn.rollback()
+        except psycopg2.Error:
+            conn.close()
+            return False
+        return True
+
+    def _close(self, conn, close_conn=False):
+        with self._pool_lock:
+            super()._close(conn, close_conn)
+            if close_conn or conn.closed:
+                self._last_used.pop(self.conn_key(conn), None)
+                self._pending_pings.discard(self.conn_key(conn))
+            else:
+                self._last_used[self.conn_key(conn)] = time.time()
+
+    def fill(self) -> None:
+        """Open connections until the pool holds at least ``min_connections``"""
+        with self._pool_lock:
+            missing = self._min_connections - len(self._connections) - len(self._in_use)
+            # Pooled checkouts would take idle connections first, so new ones are opened directly
+            for _ in range(max(missing, 0)):
+                conn = super(PooledDatabase, self)._connect()
+                now = time.time()
+                heapq.heappush(self._connections, (now, _sentinel(), conn))
+                self._last_used[self.conn_key(conn)] = now
+
+    def maintain(self) -> None:
+        """Close connections idle for too long and top the pool up to its minimum size"""
+        with self._pool_lock:
+            if self._idle_timeout is not None:
+                keep_idle = max(self._min_connections - len(self._in_use), 0)
+                available = sorted(self._connections, key=lambda item: item[0], reverse=True)
+                self._connections = []
+                for item in available:
+                    _, _, conn = item
+                    last_used = self._last_used.get(self.conn_key(conn))
+                    if len(self._connections) >= keep_idle and self._is_idle_expired(last_used):
+                        self._last_used.pop(self.conn_key(conn), None)
+                        self._close(conn, close_conn=True)
+                    else:
+                        self._connections.append(item)
+                # Items are (timestamp, sentinel, conn) tuples, so the heap order is kept
+                self._connections.sort(key=lambda item: item[0])
+            self.fill()
+        logger.debug(f'Database pool stats: {self.stats()}')
+
+    def close_all(self):
+        with self._pool_lock:
+            super().close_all()
+            self._last_used.clear()
+            self._pending_pings.clear()
+
+    def stats(self) -> PoolStats:
+        """Approximate stats read without the pool lock, metrics scrapes must never wait for it"""
+        return PoolStats(
+            max_connections=self._max_connections,
+            idle=len(self._connections),
+            checked_out=len(self._in_use),
+            waiting=self._waiting,
+            reconnects=self._reconnects,
+        )
+
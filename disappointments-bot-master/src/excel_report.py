@@ -1,17 +1,17 @@
 import pathlib
 from datetime import timedelta
-from typing import Iterable
-
-import xlsxwriter
+from typing import BinaryIO, Iterable
 
 import db
-import settings
 
 
 class DisappointmentsReport:
 
-    def __init__(self, file_path: str | pathlib.Path):
-        self._workbook = xlsxwriter.Workbook(file_path)
+    def __init__(self, file: str | pathlib.Path | BinaryIO):
+        # Imported on the first export to keep the startup light
+        import xlsxwriter
+
+        self._workbook = xlsxwriter.Workbook(file, {'constant_memory': True})
         self._worksheet = self._workbook.add_worksheet('All disappointments')
 
     def adjust_columns(self) -> None:
@@ -30,13 +30,13 @@ class DisappointmentsReport:
         for column_no, title in enumerate(titles):
             self._worksheet.write_string(0, column_no, title, title_format)
 
-    def write_disappointments(self, disappointments: Iterable[db.Disappointment]) -> None:
+    def write_disappointments(self, disappointments: Iterable[db.DisappointmentRow]) -> None:
         date_format = self._workbook.add_format({'num_format': 'mmmm d yyyy'})
         for row, disappointment in enumerate(disappointments, start=1):
             created_at_by_bishkek_time = disappointment.created_at + timedelta(hours=6)
             self._worksheet.write_datetime(row, 0, created_at_by_bishkek_time, date_format)
-            self._worksheet.write_string(row, 1, disappointment.from_user.name)
-            self._worksheet.write_string(row, 2, disappointment.to_user.name)
+            self._worksheet.write_string(row, 1, disappointment.from_user_name)
+            self._worksheet.write_string(row, 2, disappointment.to_user_name)
             self._worksheet.write_string(row, 3, disappointment.reason)
 
     def close(self) -> None:
@@ -47,11 +47,3 @@ class DisappointmentsReport:
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
-
-
-def generate_disappointments_report(disappointments: Iterable[db.Disappointment]) -> pathlib.Path:
-    with DisappointmentsReport(settings.REPORT_FILE_PATH) as report:
-        report.adjust_columns()
-        report.write_titles()
-        report.write_disappointments(disappointments)
-    return settings.REPORT_FILE_PATH
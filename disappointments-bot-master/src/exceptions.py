@@ -11,3 +11,11 @@ class UserHasNotEnoughPoints(Exception):
 
 class DisappointmentDoesNotExist(DoesNotExist):
     pass
+
+
+class InvalidUsersFile(Exception):
+    pass
+
+
+class InvalidSearchQuery(Exception):
+    pass
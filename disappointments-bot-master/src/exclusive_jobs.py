@@ -0,0 +1,88 @@
+import zlib
+from datetime import datetime, timedelta
+from typing import Any, Callable
+
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
+
+import async_db
+import db
+from utils import logger
+
+
+class ExclusiveJob:
+    """Cron job run by a single worker per scheduled time, however many workers schedule it
+
+    Workers serialize on a Postgres advisory lock, the first one runs the job and records the
+    scheduled time, the others find it recorded and only call ``sync`` to catch up with the new
+    data. Runs missed while no worker was up are recorded and caught up by a single run.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            func: Callable[[], Any],
+            trigger: CronTrigger,
+            sync: Callable[[], Any] | None = None,
+    ):
+        self.name = name
+        self.func = func
+        self.trigger = trigger
+        self.sync = sync
+        self.lock_key = zlib.crc32(name.encode())
+        self._last_seen_scheduled_at: datetime | None = None
+
+    def get_due_fire_times(self, since: datetime, now: datetime) -> list[datetime]:
+        """Fire times of the trigger after ``since`` up to ``now``"""
+        fire_times = []
+        fire_time = self.trigger.get_next_fire_time(None, since + timedelta(microseconds=1))
+        while fire_time is not None and fire_time <= now:
+            fire_times.append(fire_time)
+            fire_time = self.trigger.get_next_fire_time(fire_time, fire_time + timedelta(microseconds=1))
+        return fire_times
+
+    def run(self) -> bool:
+        """Run the job if it has not run for its latest fire time yet, return whether it ran"""
+        db.advisory_lock(self.lock_key)
+        try:
+            timezone = self.trigger.timezone
+            now = datetime.now(timezone)
+            last_run = db.get_last_job_run(self.name)
+            if last_run is None:
+                scheduled_at, missed_runs = now, 0
+            else:
+                last_scheduled_at = last_run.scheduled_at.replace(tzinfo=timezone)
+                fire_times = self.get_due_fire_times(last_scheduled_at, now)
+                if not fire_times:
+                    self._sync_with(last_run.scheduled_at)
+                    return False
+                scheduled_at, missed_runs = fire_times[-1], len(fire_times) - 1
+            if missed_runs:
+                logger.warning(f'Catching up {missed_runs} missed runs of {self.name} job')
+            scheduled_at = scheduled_at.replace(tzinfo=None)
+            with db.engine.atomic():
+                self.func()
+                db.save_job_run(self.name, scheduled_at, missed_runs)
+            self._last_seen_scheduled_at = scheduled_at
+            return True
+        finally:
+            db.advisory_unlock(self.lock_key)
+
+    def _sync_with(self, scheduled_at: datetime) -> None:
+        if self.sync is not None and self._last_seen_scheduled_at not in (None, scheduled_at):
+            self.sync()
+        self._last_seen_scheduled_at = scheduled_at
+
+    async def run_async(self) -> bool:
+        return await async_db.run_sync(self.run)
+
+    def schedule(self, scheduler: AsyncIOScheduler) -> None:
+        """Add the job to the scheduler, it also runs once right away to catch up missed runs"""
+        scheduler.add_job(
+            self.run_async,
+            self.trigger,
+            id=self.name,
+            next_run_time=datetime.now(self.trigger.timezone),
+            coalesce=True,
+            misfire_grace_time=None,
+        )
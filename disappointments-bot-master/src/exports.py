@@ -0,0 +1,164 @@
+import csv
+import gzip
+import io
+import itertools
+import json
+import tempfile
+import threading
+from datetime import datetime, time, timedelta, timezone
+from typing import BinaryIO, Iterable, NamedTuple
+
+import db
+import settings
+from archive import iter_archived_disappointments
+from excel_report import DisappointmentsReport
+
+EXPORT_COLUMNS = ('created_at', 'from_user', 'to_user', 'reason')
+EXPORT_PERIODS: dict[str, timedelta | None] = {
+    'all': None,
+    'month': timedelta(days=30),
+    'week': timedelta(days=7),
+}
+# Everything including the archived disappointments, offered once old months get archived
+ARCHIVE_PERIOD = 'archive'
+if settings.DISAPPOINTMENTS_RETENTION_MONTHS is not None:
+    EXPORT_PERIODS[ARCHIVE_PERIOD] = None
+
+
+def _format_created_at(disappointment: db.DisappointmentRow) -> str:
+    # Disappointments are stored in UTC, as the Excel report assumes
+    return disappointment.created_at.replace(tzinfo=timezone.utc).isoformat()
+
+
+class Exporter:
+    """Writes disappointments to a binary file in one format"""
+    name: str
+    title: str
+    file_extension: str
+
+    def write(self, disappointments: Iterable[db.DisappointmentRow], file: BinaryIO) -> None:
+        raise NotImplementedError
+
+
+class XlsxExporter(Exporter):
+    name = 'xlsx'
+    title = 'Excel'
+    file_extension = '.xlsx'
+
+    def write(self, disappointments: Iterable[db.DisappointmentRow], file: BinaryIO) -> None:
+        with DisappointmentsReport(file) as report:
+            report.adjust_columns()
+            report.write_titles()
+            report.write_disappointments(disappointments)
+
+
+class CsvExporter(Exporter):
+    name = 'csv'
+    title = 'CSV'
+    file_extension = '.csv.gz'
+
+    def write(self, disappointments: Iterable[db.DisappointmentRow], file: BinaryIO) -> None:
+        with gzip.GzipFile(fileobj=file, mode='wb') as compressed_file:
+            text_file = io.TextIOWrapper(compressed_file, encoding='utf-8', newline='')
+            writer = csv.writer(text_file)
+            writer.writerow(EXPORT_COLUMNS)
+            writer.writerows(
+                (_format_created_at(disappointment),
+                 disappointment.from_user_name,
+                 disappointment.to_user_name,
+                 disappointment.reason)
+                for disappointment in disappointments
+            )
+            text_file.flush()
+            text_file.detach()
+
+
+class NdjsonExporter(Exporter):
+    name = 'ndjson'
+    title = 'NDJSON'
+    file_extension = '.ndjson.gz'
+
+    def write(self, disappointments: Iterable[db.DisappointmentRow], file: BinaryIO) -> None:
+        with gzip.GzipFile(fileobj=file, mode='wb') as compressed_file:
+            for disappointment in disappointments:
+                line = json.dumps({
+                    'created_at': _format_created_at(disappointment),
+                    'from_user': disappointment.from_user_name,
+                    'to_user': disappointment.to_user_name,
+                    'reason': disappointment.reason,
+                }, ensure_ascii=False)
+                compressed_file.write(line.encode() + b'\n')
+
+
+EXPORTERS: dict[str, Exporter] = {
+    exporter.name: exporter
+    for exporter in (XlsxExporter(), CsvExporter(), NdjsonExporter())
+}
+
+
+class Export(NamedTuple):
+    format: str
+    period: str
+    since: datetime | None
+    data_version: db.DataVersion
+    file_name: str
+    # Temporary file with the export, rewound to the start, the caller closes it
+    content: BinaryIO | None = None
+    telegram_file_id: str | None = None
+
+
+# (format, period) -> (period start, data version, file id of the document uploaded to Telegram)
+_telegram_file_ids: dict[tuple[str, str], tuple[datetime | None, db.DataVersion, str]] = {}
+_telegram_file_ids_lock = threading.Lock()
+
+
+def get_period_start(period: str) -> datetime | None:
+    """Start of the period, rounded down to midnight so exports of the same day can be reused"""
+    length = EXPORT_PERIODS[period]
+    if length is None:
+        return None
+    return datetime.combine(datetime.now().date(), time()) - length
+
+
+def get_export_file_name(format_name: str, period: str, since: datetime | None) -> str:
+    if period == ARCHIVE_PERIOD:
+        suffix = '-with-archive'
+    else:
+        suffix = '' if since is None else f'-since-{since:%Y-%m-%d}'
+    return f'disappointments{suffix}{EXPORTERS[format_name].file_extension}'
+
+
+def get_export(format_name: str, period: str) -> Export:
+    """Export disappointments of the period, if the same export was uploaded already only its file id is returned"""
+    since = get_period_start(period)
+    data_version = db.get_disappointments_data_version()
+    export = Export(
+        format=format_name,
+        period=period,
+        since=since,
+        data_version=data_version,
+        file_name=get_export_file_name(format_name, period, since),
+    )
+    with _telegram_file_ids_lock:
+        uploaded = _telegram_file_ids.get((format_name, period))
+    if uploaded is not None and uploaded[:2] == (since, data_version):
+        return export._replace(telegram_file_id=uploaded[2])
+    disappointments = db.iter_disappointments(since=since)
+    if period == ARCHIVE_PERIOD:
+        # Archived months are older than any disappointment left, so the rows stay in order
+        disappointments = itertools.chain(iter_archived_disappointments(), disappointments)
+    # Big exports are written to disk, so they are not held in memory while uploading
+    file = tempfile.TemporaryFile()
+    try:
+        EXPORTERS[format_name].write(disappointments, file)
+        file.seek(0)
+    except BaseException:
+        file.close()
+        raise
+    return export._replace(content=file)
+
+
+def remember_export_telegram_file_id(export: Export, file_id: str) -> None:
+    """Let next requests of the same export reuse the already uploaded document"""
+    with _telegram_file_ids_lock:
+        _telegram_file_ids[export.format, export.period] = (export.since, export.data_version, file_id)
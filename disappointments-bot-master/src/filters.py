@@ -4,6 +4,7 @@ from aiogram.dispatcher.filters import BoundFilter
 from aiogram.types import Message
 
 import db
+import settings
 from utils import get_user_id
 
 
@@ -15,8 +16,15 @@ class UserInDBFilter(BoundFilter):
 
     async def check(self, message: Message) -> Union[bool, dict]:
         user_telegram_id = get_user_id(message)
-        is_user_in_db = user_telegram_id in db.ALL_USER_TELEGRAM_IDS
+        is_user_in_db = db.users_cache.has_telegram_id(user_telegram_id)
         if is_user_in_db and self._returning_user:
-            user = db.get_user_by_telegram_id(user_telegram_id)
+            user = db.users_cache.get_by_telegram_id(user_telegram_id)
             return {'user': user}
         return is_user_in_db
+
+
+class AdminFilter(BoundFilter):
+    key = 'is_admin'
+
+    async def check(self, message: Message) -> bool:
+        return get_user_id(message) in settings.ADMIN_TELEGRAM_IDS
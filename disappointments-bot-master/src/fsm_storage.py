@@ -0,0 +1,101 @@
+import typing
+
+from aiogram.dispatcher.storage import BaseStorage
+
+import async_db
+
+ChatOrUser = typing.Union[str, int, None]
+
+
+class PostgresStorage(BaseStorage):
+    """FSM storage keeping states in Postgres, so they survive restarts and are shared by workers
+
+    Records that were not updated for ``FSM_STATE_TTL`` seconds are treated as absent
+    and deleted by the scheduled cleanup.
+    """
+
+    async def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    def resolve_address(self, chat: ChatOrUser, user: ChatOrUser) -> tuple[int, int]:
+        chat, user = self.check_address(chat=chat, user=user)
+        return int(chat), int(user)
+
+    async def get_state(self, *,
+                        chat: ChatOrUser = None,
+                        user: ChatOrUser = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        record = await async_db.get_fsm_record(*self.resolve_address(chat, user))
+        if record is None or record.state is None:
+            return self.resolve_state(default)
+        return record.state
+
+    async def get_data(self, *,
+                       chat: ChatOrUser = None,
+                       user: ChatOrUser = None,
+                       default: typing.Optional[dict] = None) -> typing.Dict:
+        record = await async_db.get_fsm_record(*self.resolve_address(chat, user))
+        if record is None:
+            return default or {}
+        return record.data
+
+    async def set_state(self, *,
+                        chat: ChatOrUser = None,
+                        user: ChatOrUser = None,
+                        state: typing.AnyStr = None):
+        await async_db.save_fsm_record(
+            *self.resolve_address(chat, user),
+            state=self.resolve_state(state),
+        )
+
+    async def set_data(self, *,
+                       chat: ChatOrUser = None,
+                       user: ChatOrUser = None,
+                       data: typing.Dict = None):
+        await async_db.save_fsm_record(*self.resolve_address(chat, user), data=data or {})
+
+    async def update_data(self, *,
+                          chat: ChatOrUser = None,
+                          user: ChatOrUser = None,
+                          data: typing.Dict = None,
+                          **kwargs):
+        values = {**(data or {}), **kwargs}
+        await async_db.update_fsm_record_values(*self.resolve_address(chat, user), 'data', values)
+
+    async def reset_state(self, *,
+                          chat: ChatOrUser = None,
+                          user: ChatOrUser = None,
+                          with_data: typing.Optional[bool] = True):
+        values = {'state': None}
+        if with_data:
+            values['data'] = {}
+        await async_db.save_fsm_record(*self.resolve_address(chat, user), **values)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *,
+                         chat: ChatOrUser = None,
+                         user: ChatOrUser = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        record = await async_db.get_fsm_record(*self.resolve_address(chat, user))
+        if record is None:
+            return default or {}
+        return record.bucket
+
+    async def set_bucket(self, *,
+                         chat: ChatOrUser = None,
+                         user: ChatOrUser = None,
+                         bucket: typing.Dict = None):
+        await async_db.save_fsm_record(*self.resolve_address(chat, user), bucket=bucket or {})
+
+    async def update_bucket(self, *,
+                            chat: ChatOrUser = None,
+                            user: ChatOrUser = None,
+                            bucket: typing.Dict = None,
+                            **kwargs):
+        values = {**(bucket or {}), **kwargs}
+        await async_db.update_fsm_record_values(*self.resolve_address(chat, user), 'bucket', values)
@@ -1,26 +1,51 @@
+from datetime import timedelta
+
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters import Text
 from aiogram.dispatcher.filters.state import StatesGroup, State
-from aiogram.types import Message, ChatType, CallbackQuery, Update, ChatActions
+from aiogram.types import (
+    Message,
+    ChatType,
+    CallbackQuery,
+    Update,
+    ChatActions,
+    InputFile,
+    ContentType,
+    InlineQuery,
+    InlineQueryResultArticle,
+    InputTextMessageContent,
+)
 from aiogram.utils.markdown import html_decoration
 
+import async_db
 import db
 import exceptions
+import settings
 import utils
 from bot import dp
-from excel_report import generate_disappointments_report
-from filters import UserInDBFilter
+from exports import EXPORTERS, EXPORT_PERIODS, get_export, remember_export_telegram_file_id
+from filters import UserInDBFilter, AdminFilter
 from keyboards import (
-    UsersListWithIDsMarkup,
-    MainMenuMarkup,
+    MAIN_MENU_MARKUP,
     view_disappointment_cd,
-    DownloadAsExcelMarkup,
-    UserDisappointmentsMenuMarkup,
+    DOWNLOAD_AS_EXCEL_MARKUP,
+    USER_DISAPPOINTMENTS_MENU_MARKUP,
     delete_disappointment_cd,
-    ProfileMenuMarkup,
+    PROFILE_MENU_MARKUP,
     DisappointmentMenuMarkup,
+    DisappointmentsPageMarkup,
+    from_user_disappointments_page_cd,
+    to_user_disappointments_page_cd,
+    export_cd,
+    choose_user_cd,
+    users_page_cd,
+    users_picker_markups,
+    search_page_cd,
+    SearchPageMarkup,
 )
 from telegram_helper import notify_new_disappointment, notify_deleted_disappointment
+from search import SEARCH_HELP, parse_search_query
+from users_import import parse_users
 from validators import check_user_has_enough_points
 
 
@@ -29,6 +54,10 @@ class AddDisappointmentStates(StatesGroup):
     reason = State()
 
 
+class ImportUsersStates(StatesGroup):
+    file = State()
+
+
 @dp.errors_handler(exception=exceptions.DisappointmentDoesNotExist)
 async def on_disappointment_does_not_exist_error(update: Update, exception):
     text = 'This disappointment does not exist'
@@ -41,29 +70,145 @@ async def on_disappointment_does_not_exist_error(update: Update, exception):
 
 @dp.errors_handler(exception=exceptions.UserHasNotEnoughPoints)
 async def on_user_has_not_enough_points_error(update: Update, exception):
-    text = ('You have no points to add disappointment point.'
-            ' They are updated once in 3 hours, so please wait')
+    if settings.POINTS_REFILL_MODE == 'rolling':
+        refill_text = f'They come back in {settings.POINTS_REFILL_HOURS} hours after you started spending them'
+    else:
+        refill_text = f'They are updated once in {settings.POINTS_REFILL_HOURS} hours'
+    text = f'You have no points to add disappointment point. {refill_text}, so please wait'
+    # The default MarkdownV2 would reject the unescaped dot
     if update.message is not None:
-        await update.message.answer(text)
+        await update.message.answer(text, parse_mode='html')
+    elif update.callback_query is not None:
+        await update.callback_query.message.answer(text, parse_mode='html')
+    return True
+
+
+@dp.errors_handler(exception=exceptions.InvalidUsersFile)
+async def on_invalid_users_file_error(update: Update, exception):
+    text = html_decoration.quote(f'Users were not imported. {exception}')
+    await update.message.answer(text, parse_mode='html')
+    return True
+
+
+@dp.errors_handler(exception=exceptions.InvalidSearchQuery)
+async def on_invalid_search_query_error(update: Update, exception):
+    if update.inline_query is not None:
+        await update.inline_query.answer([], cache_time=0, is_personal=True)
+        return True
+    text = html_decoration.quote(f'{exception}\n\n{SEARCH_HELP}')
+    if update.message is not None:
+        await update.message.answer(text, parse_mode='html')
     elif update.callback_query is not None:
-        await update.callback_query.message.answer(text)
+        await update.callback_query.message.answer(text, parse_mode='html')
+        await update.callback_query.answer()
     return True
 
 
-@dp.callback_query_handler(Text('from-user-disappointments'), UserInDBFilter(), state='*')
-async def on_from_user_disappointments_cb(callback_query: CallbackQuery):
-    disappointments = db.get_disappointments_from_user_by_telegram_id(callback_query.from_user.id)
-    for disappointments_group in utils.gen_group_items(disappointments, group_by=10):
-        lines = ['Disappointments by you:']
-        for disappointment in disappointments_group:
-            lines += (
-                html_decoration.bold(f'To {disappointment.to_user.name}: ') +
-                html_decoration.italic(f'{disappointment.reason.capitalize()}'),
-                f'/disappointment_{disappointment.id}',
-                '',
-            )
-        text = '\n'.join(lines)
-        await callback_query.message.answer(text, parse_mode='html')
+def build_from_user_disappointments_text(disappointments: list[db.DisappointmentRow]) -> str:
+    if not disappointments:
+        return 'You have not added any disappointments yet'
+    lines = ['Disappointments by you:']
+    for disappointment in disappointments:
+        lines += (
+            html_decoration.bold(html_decoration.quote(f'To {disappointment.to_user_name}: ')) +
+            html_decoration.italic(html_decoration.quote(disappointment.reason.capitalize())),
+            f'/disappointment_{disappointment.id}',
+            '',
+        )
+    return '\n'.join(lines)
+
+
+def build_to_user_disappointments_text(disappointments: list[db.DisappointmentRow]) -> str:
+    if not disappointments:
+        return 'Nobody has been disappointed in you yet'
+    lines = ['Disappointments in you:']
+    for disappointment in disappointments:
+        lines += (
+            html_decoration.bold(html_decoration.quote(f'From {disappointment.from_user_name}: ')) +
+            html_decoration.italic(html_decoration.quote(disappointment.reason.capitalize())),
+            f'/disappointment_{disappointment.id}',
+            '',
+        )
+    return '\n'.join(lines)
+
+
+def build_disappointment_text(disappointment: db.DisappointmentRow) -> str:
+    return (f'💩 From user: {html_decoration.bold(html_decoration.quote(disappointment.from_user_name))}\n'
+            f'😺 To user: {html_decoration.bold(html_decoration.quote(disappointment.to_user_name))}\n'
+            f'📅 Created at: {html_decoration.bold(disappointment.created_at.strftime("%H:%M %d.%m.%Y"))}\n'
+            f'💬 Reason: {html_decoration.italic(html_decoration.quote(disappointment.reason))}')
+
+
+def build_search_results_text(page: db.SearchPage) -> str:
+    if not page.disappointments:
+        return 'Nothing found'
+    lines = []
+    for disappointment in page.disappointments:
+        from_to = html_decoration.quote(f'{disappointment.from_user_name} → {disappointment.to_user_name}')
+        lines += (
+            f'{html_decoration.bold(from_to)} '
+            f'{disappointment.created_at.strftime("%d.%m.%Y")}: '
+            f'{html_decoration.italic(html_decoration.quote(disappointment.reason))}',
+            f'/disappointment_{disappointment.id}',
+            '',
+        )
+    return '\n'.join(lines)
+
+
+def build_statistics_text(statistics: db.Statistics) -> str:
+    lines = [html_decoration.bold('👎 Most disappointing')]
+    lines += [
+        f'{place}. {html_decoration.quote(row.name)}: {row.count}'
+        for place, row in enumerate(statistics.received_leaderboard, start=1)
+    ] or ['Nobody yet']
+    lines += ['', html_decoration.bold('👉 Most disappointed')]
+    lines += [
+        f'{place}. {html_decoration.quote(row.name)}: {row.count}'
+        for place, row in enumerate(statistics.given_leaderboard, start=1)
+    ] or ['Nobody yet']
+    lines += ['', html_decoration.bold('📅 By day')]
+    lines += [f'{row.period_start:%d.%m}: {row.count}' for row in statistics.daily_trend]
+    lines += ['', html_decoration.bold('🗓 By week')]
+    lines += [f'{row.period_start:%d.%m} – {row.period_start + timedelta(days=6):%d.%m}: {row.count}'
+              for row in statistics.weekly_trend]
+    return '\n'.join(lines)
+
+
+@dp.callback_query_handler(
+    Text('from-user-disappointments'),
+    UserInDBFilter(returning_user=True),
+    state='*',
+)
+async def on_from_user_disappointments_cb(callback_query: CallbackQuery, user: db.User):
+    page = await async_db.get_disappointments_page_from_user(user.id)
+    text = build_from_user_disappointments_text(page.disappointments)
+    markup = DisappointmentsPageMarkup(page, from_user_disappointments_page_cd)
+    await callback_query.message.answer(text, reply_markup=markup, parse_mode='html')
+    await callback_query.answer()
+
+
+@dp.callback_query_handler(
+    from_user_disappointments_page_cd.filter(),
+    UserInDBFilter(returning_user=True),
+    state='*',
+)
+async def on_from_user_disappointments_page_cb(
+        callback_query: CallbackQuery,
+        callback_data: dict,
+        user: db.User,
+):
+    cursor = db.PageCursor(
+        created_at=utils.microseconds_to_datetime(callback_data['created_at']),
+        id=int(callback_data['disappointment_id']),
+    )
+    page = await async_db.get_disappointments_page_from_user(
+        user.id,
+        cursor=cursor,
+        backward=callback_data['direction'] == 'previous',
+    )
+    text = build_from_user_disappointments_text(page.disappointments)
+    markup = DisappointmentsPageMarkup(page, from_user_disappointments_page_cd)
+    await callback_query.message.edit_text(text, reply_markup=markup, parse_mode='html')
     await callback_query.answer()
 
 
@@ -74,33 +219,78 @@ async def on_from_user_disappointments_cb(callback_query: CallbackQuery):
 )
 async def on_delete_disappointment_cb(callback_query: CallbackQuery, callback_data: dict):
     disappointment_id = callback_data['disappointment_id']
-    disappointment = db.get_disappointment_by_id(disappointment_id)
-    disappointment.delete_instance()
-    await notify_deleted_disappointment(disappointment)
+    disappointment = await async_db.get_disappointment_by_id(disappointment_id)
+    # A concurrent tap may have deleted it in between, only the one that deleted it notifies
+    if not await async_db.delete_disappointment_by_id(disappointment.id):
+        raise exceptions.DisappointmentDoesNotExist
+    notify_deleted_disappointment(disappointment)
     await callback_query.answer('Deleted', show_alert=True)
     await callback_query.message.delete()
 
 
-@dp.callback_query_handler(Text('to-user-disappointments'), UserInDBFilter(), state='*')
-async def on_to_user_disappointments_cb(callback_query: CallbackQuery):
-    await callback_query.answer('In development', show_alert=True)
+@dp.callback_query_handler(
+    Text('to-user-disappointments'),
+    UserInDBFilter(returning_user=True),
+    state='*',
+)
+async def on_to_user_disappointments_cb(callback_query: CallbackQuery, user: db.User):
+    page = await async_db.get_disappointments_page_to_user(user.id)
+    text = build_to_user_disappointments_text(page.disappointments)
+    markup = DisappointmentsPageMarkup(page, to_user_disappointments_page_cd)
+    await callback_query.message.answer(text, reply_markup=markup, parse_mode='html')
+    await callback_query.answer()
+
+
+@dp.callback_query_handler(
+    to_user_disappointments_page_cd.filter(),
+    UserInDBFilter(returning_user=True),
+    state='*',
+)
+async def on_to_user_disappointments_page_cb(
+        callback_query: CallbackQuery,
+        callback_data: dict,
+        user: db.User,
+):
+    cursor = db.PageCursor(
+        created_at=utils.microseconds_to_datetime(callback_data['created_at']),
+        id=int(callback_data['disappointment_id']),
+    )
+    page = await async_db.get_disappointments_page_to_user(
+        user.id,
+        cursor=cursor,
+        backward=callback_data['direction'] == 'previous',
+    )
+    text = build_to_user_disappointments_text(page.disappointments)
+    markup = DisappointmentsPageMarkup(page, to_user_disappointments_page_cd)
+    await callback_query.message.edit_text(text, reply_markup=markup, parse_mode='html')
+    await callback_query.answer()
 
 
+# Buttons sent before exports got formats and periods still say 'download-as-excel'
 @dp.callback_query_handler(Text('download-as-excel'), UserInDBFilter(), state='*')
-async def on_download_as_excel_cb(callback_query: CallbackQuery):
+@dp.callback_query_handler(
+    export_cd.filter(format=list(EXPORTERS), period=list(EXPORT_PERIODS)),
+    UserInDBFilter(),
+    state='*',
+)
+async def on_download_as_excel_cb(callback_query: CallbackQuery, callback_data: dict | None = None):
+    callback_data = callback_data or {'format': 'xlsx', 'period': 'all'}
     await ChatActions.upload_document()
-    disappointments = db.get_all_disappointments()
-    report_path = generate_disappointments_report(disappointments)
-    with open(report_path, 'rb') as file:
-        await callback_query.message.answer_document(file)
+    export = await async_db.run_sync(get_export, callback_data['format'], callback_data['period'])
+    if export.telegram_file_id is not None:
+        await callback_query.message.answer_document(export.telegram_file_id)
+    else:
+        with export.content:
+            document = InputFile(export.content, filename=export.file_name)
+            message = await callback_query.message.answer_document(document)
+        remember_export_telegram_file_id(export, message.document.file_id)
     await callback_query.answer()
 
 
 @dp.callback_query_handler(Text('user-disappointments'), UserInDBFilter(), state='*')
 async def on_user_disappointments_menu_cb(callback_query: CallbackQuery):
     text = 'Do you wanna show disappointments that *are from you* or *to you*'
-    markup = UserDisappointmentsMenuMarkup()
-    await callback_query.message.answer(text, reply_markup=markup)
+    await callback_query.message.answer(text, reply_markup=USER_DISAPPOINTMENTS_MENU_MARKUP)
     await callback_query.answer()
 
 
@@ -110,21 +300,96 @@ async def on_message_in_group(message: Message):
     await message.answer('This bot is not allowed for using in groups')
 
 
+@dp.message_handler(AdminFilter(), commands='import_users', state='*')
+async def on_import_users_command(message: Message):
+    await ImportUsersStates.file.set()
+    await message.answer('Send a .csv or .json file with name and telegram_id of the users', parse_mode='html')
+
+
+@dp.message_handler(AdminFilter(), content_types=ContentType.DOCUMENT, state=ImportUsersStates.file)
+async def on_users_file(message: Message, state: FSMContext):
+    document = message.document
+    if document.file_size > settings.USERS_IMPORT_MAX_FILE_SIZE:
+        raise exceptions.InvalidUsersFile('The file is too big')
+    content = await message.bot.download_file_by_id(document.file_id)
+    users = await async_db.run_sync(parse_users, content.getvalue(), document.file_name or '')
+    changed_users_count = await async_db.import_users(users)
+    await state.finish()
+    await message.answer(f'{len(users)} users imported, {changed_users_count} of them are new or renamed',
+                         parse_mode='html')
+
+
+async def search(query: str, offset: int = 0) -> tuple[str, SearchPageMarkup]:
+    search_query = parse_search_query(query, db.users_cache.get_all())
+    if search_query.is_empty():
+        raise exceptions.InvalidSearchQuery('Nothing to search for')
+    page = await async_db.search_disappointments(search_query, offset=offset)
+    return build_search_results_text(page), SearchPageMarkup(page, settings.SEARCH_PAGE_SIZE)
+
+
+@dp.message_handler(UserInDBFilter(), commands='search', state='*')
+async def on_search_command(message: Message, state: FSMContext):
+    query = message.get_args()
+    text, markup = await search(query)
+    # Callback data is too short for the query, so pages take it from the state data
+    await state.update_data(search_query=query)
+    await message.answer(text, reply_markup=markup, parse_mode='html')
+
+
+@dp.callback_query_handler(search_page_cd.filter(), UserInDBFilter(), state='*')
+async def on_search_page_cb(callback_query: CallbackQuery, callback_data: dict, state: FSMContext):
+    query = (await state.get_data()).get('search_query')
+    if query is None:
+        await callback_query.answer('This search is over, search again with /search', show_alert=True)
+        return
+    text, markup = await search(query, offset=int(callback_data['offset']))
+    await callback_query.message.edit_text(text, reply_markup=markup, parse_mode='html')
+    await callback_query.answer()
+
+
+@dp.inline_handler(UserInDBFilter())
+async def on_search_inline_query(inline_query: InlineQuery):
+    search_query = parse_search_query(inline_query.query, db.users_cache.get_all())
+    offset = int(inline_query.offset or 0)
+    page = await async_db.search_disappointments(
+        search_query,
+        offset=offset,
+        page_size=settings.SEARCH_INLINE_PAGE_SIZE,
+    )
+    results = [
+        InlineQueryResultArticle(
+            id=str(disappointment.id),
+            title=f'{disappointment.from_user_name} → {disappointment.to_user_name}',
+            description=disappointment.reason,
+            input_message_content=InputTextMessageContent(
+                build_disappointment_text(disappointment),
+                parse_mode='html',
+            ),
+        )
+        for disappointment in page.disappointments
+    ]
+    next_offset = str(offset + settings.SEARCH_INLINE_PAGE_SIZE) if page.has_next else ''
+    await inline_query.answer(results, cache_time=0, is_personal=True, next_offset=next_offset)
+
+
 @dp.message_handler(Text(startswith='/disappointment_'), UserInDBFilter(), state='*')
 async def on_view_exact_disappointment(message: Message):
     disappointment_id = message.text.split('_')[-1]
-    disappointment = db.get_disappointment_by_id(disappointment_id)
+    disappointment = await async_db.get_disappointment_by_id(disappointment_id)
     markup = DisappointmentMenuMarkup(disappointment_id)
-    text = (f'💩 From user: {html_decoration.bold(disappointment.from_user.name)}\n'
-            f'😺 To user: {html_decoration.bold(disappointment.to_user.name)}\n'
-            f'📅 Created at: {html_decoration.bold(disappointment.created_at.strftime("%H:%M %d.%m.%Y"))}\n'
-            f'💬 Reason: {html_decoration.italic(disappointment.reason)}')
-    await message.answer(text, reply_markup=markup, parse_mode='html')
+    await message.answer(build_disappointment_text(disappointment), reply_markup=markup, parse_mode='html')
 
 
-@dp.callback_query_handler(UserInDBFilter(), state=AddDisappointmentStates.user)
-async def choose_user_for_disappointment(callback_query: CallbackQuery, state: FSMContext):
-    await state.update_data(user_id=callback_query.data)
+@dp.callback_query_handler(users_page_cd.filter(), UserInDBFilter(), state=AddDisappointmentStates.user)
+async def on_users_page_cb(callback_query: CallbackQuery, callback_data: dict):
+    markup = users_picker_markups.get_page(int(callback_data['offset']))
+    await callback_query.message.edit_reply_markup(markup)
+    await callback_query.answer()
+
+
+@dp.callback_query_handler(choose_user_cd.filter(), UserInDBFilter(), state=AddDisappointmentStates.user)
+async def choose_user_for_disappointment(callback_query: CallbackQuery, callback_data: dict, state: FSMContext):
+    await state.update_data(user_id=callback_data['user_id'])
     await AddDisappointmentStates.reason.set()
     await callback_query.message.answer('Your reason 👇')
     await callback_query.answer()
@@ -132,28 +397,35 @@ async def choose_user_for_disappointment(callback_query: CallbackQuery, state: F
 
 @dp.message_handler(UserInDBFilter(), Text('😈 All disappointments'), state='*')
 async def on_all_disappointments_command(message: Message):
-    markup = DownloadAsExcelMarkup()
-    await message.answer('Disappointments', reply_markup=markup)
+    await message.answer('Disappointments', reply_markup=DOWNLOAD_AS_EXCEL_MARKUP)
+
+
+@dp.message_handler(UserInDBFilter(), Text('📊 Statistics'), state='*')
+async def on_statistics_command(message: Message):
+    statistics = await async_db.get_statistics()
+    await message.answer(build_statistics_text(statistics), parse_mode='html')
 
 
 @dp.message_handler(Text('👎 New disappointment'), UserInDBFilter(returning_user=True), state='*')
 async def new_disappointment(message: Message, user: db.User):
     check_user_has_enough_points(user)
-    markup = UsersListWithIDsMarkup(db.get_all_users())
+    markup = users_picker_markups.get_page()
     await AddDisappointmentStates.user.set()
-    await message.answer('Who do you wanna add disappointment to?', reply_markup=markup)
+    await message.answer('Who do you wanna add disappointment to? Send a part of the name to search',
+                         reply_markup=markup)
 
 
 @dp.message_handler(UserInDBFilter(returning_user=True), state=AddDisappointmentStates.reason)
 async def on_disappointment_reason(message: Message, state: FSMContext, user: db.User):
     state_data = await state.get_data()
     user_id = state_data['user_id']
-    check_user_has_enough_points(user)
-    to_user = db.get_user_by_id(user_id)
-    disappointment = db.add_disappointment(from_user=user, to_user=to_user, reason=message.text)
-    user.points = user.points - 1
-    user.save()
-    await notify_new_disappointment(to_user, disappointment.id)
+    to_user = db.users_cache.get_by_id(user_id)
+    disappointment = await async_db.add_disappointment_spending_point(
+        from_user=user,
+        to_user=to_user,
+        reason=message.text,
+    )
+    notify_new_disappointment(to_user, disappointment.id)
     await message.answer(f'You added new disappointment to user *{to_user.name}*\n'
                          f'Reason: _{disappointment.reason}_')
     await state.finish()
@@ -166,28 +438,39 @@ async def on_disappointment_reason(message: Message, state: FSMContext, user: db
 )
 async def on_view_disappointment_button(callback_query: CallbackQuery, callback_data: dict):
     disappointment_id = callback_data['disappointment_id']
-    disappointment = db.get_disappointment_by_id(disappointment_id)
-    text = (f'💩 From user: <b>{disappointment.from_user.name}</b>\n'
-            f'😺 To user: <b>{disappointment.to_user.name}</b>\n'
-            f'📅 Created at: <b>{disappointment.created_at.strftime("%H:%M %d.%m.%Y")}</b>\n'
-            f'💬 Reason: <i>{disappointment.reason}</i>')
-    await callback_query.message.answer(text, parse_mode='html')
+    disappointment = await async_db.get_disappointment_by_id(disappointment_id)
+    await callback_query.message.answer(build_disappointment_text(disappointment), parse_mode='html')
     await callback_query.answer()
 
 
 @dp.message_handler(Text('😺 Profile'), UserInDBFilter(returning_user=True), state='*')
 async def on_profile_command(message: Message, user: db.User):
+    user_stats = await async_db.get_user_stats(user.id)
     text = (f'➖➖➖➖➖➖➖➖➖➖\n'
             f'👤 Name: *{user.name}*\n'
-            f'⭐️ Points left: *{user.points}*\n'
-            f'👎 Disappointments from other people: *{db.get_user_disappointments_amount(user)}*\n'
+            f'⭐️ Points left: *{user.get_available_points()}*\n'
+            f'👎 Disappointments from other people: *{user_stats.received_count}*\n'
+            f'👉 Disappointments in other people: *{user_stats.given_count}*\n'
             f'➖➖➖➖➖➖➖➖➖➖')
-    await message.answer(text, reply_markup=ProfileMenuMarkup())
+    await message.answer(text, reply_markup=PROFILE_MENU_MARKUP)
+
+
+# After the menu buttons, so they still work while a user is being chosen
+@dp.message_handler(UserInDBFilter(), state=AddDisappointmentStates.user)
+async def on_search_user_for_disappointment(message: Message):
+    found_count, markup = users_picker_markups.search(message.text or '')
+    if markup is None:
+        await message.answer('Nobody found, try another name')
+        return
+    text = f'Found {found_count} users'
+    if found_count > settings.USERS_PICKER_PAGE_SIZE:
+        text += f', showing the first {settings.USERS_PICKER_PAGE_SIZE}, send a longer part of the name'
+    await message.answer(text, reply_markup=markup)
 
 
 @dp.message_handler(UserInDBFilter(), state='*')
 async def undefined_user(message: Message, state: FSMContext):
-    await message.answer('Main menu is always with you ☺️', reply_markup=MainMenuMarkup())
+    await message.answer('Main menu is always with you ☺️', reply_markup=MAIN_MENU_MARKUP)
     await state.finish()
 
 
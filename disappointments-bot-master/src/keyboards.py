@@ -1,13 +1,34 @@
-from typing import Iterable
+from typing import Sequence
 
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, \
     InlineKeyboardButton
+from aiogram.utils import json
 from aiogram.utils.callback_data import CallbackData
 
 import db
+import settings
+from exports import EXPORTERS, EXPORT_PERIODS
+from users_cache import UsersCache
+from utils import datetime_to_microseconds
 
 view_disappointment_cd = CallbackData('view-disappointment', 'disappointment_id')
 delete_disappointment_cd = CallbackData('delete-disappointment', 'disappointment_id')
+export_cd = CallbackData('export', 'format', 'period')
+choose_user_cd = CallbackData('choose-user', 'user_id')
+users_page_cd = CallbackData('users-page', 'offset')
+search_page_cd = CallbackData('search-page', 'offset')
+from_user_disappointments_page_cd = CallbackData(
+    'from-user-page',
+    'direction',
+    'created_at',
+    'disappointment_id',
+)
+to_user_disappointments_page_cd = CallbackData(
+    'to-user-page',
+    'direction',
+    'created_at',
+    'disappointment_id',
+)
 
 
 class ViewDisappointmentButton(InlineKeyboardButton):
@@ -31,23 +52,57 @@ class MainMenuMarkup(ReplyKeyboardMarkup):
                 ],
                 [
                     KeyboardButton('👎 New disappointment'),
+                    KeyboardButton('📊 Statistics'),
                 ],
             ]
         )
 
 
-class UsersListWithIDsMarkup(InlineKeyboardMarkup):
+class UsersPickerMarkup(InlineKeyboardMarkup):
+    """One page of users to choose from, with buttons to the neighbouring pages"""
 
-    def __init__(self, users: Iterable[db.User]):
+    def __init__(self, users: Sequence[db.User], offset: int = 0, page_size: int | None = None):
         super().__init__(row_width=1)
-        self.add(*(InlineKeyboardButton(user.name, callback_data=user.id) for user in users))
+        page_size = page_size or len(users)
+        page = users[offset:offset + page_size]
+        self.add(*(
+            InlineKeyboardButton(user.name, callback_data=choose_user_cd.new(user_id=user.id))
+            for user in page
+        ))
+        buttons = []
+        if offset > 0:
+            buttons.append(InlineKeyboardButton(
+                '⬅️ Previous',
+                callback_data=users_page_cd.new(offset=max(offset - page_size, 0)),
+            ))
+        if offset + page_size < len(users):
+            buttons.append(InlineKeyboardButton(
+                'Next ➡️',
+                callback_data=users_page_cd.new(offset=offset + page_size),
+            ))
+        if buttons:
+            self.row(*buttons)
 
 
 class DownloadAsExcelMarkup(InlineKeyboardMarkup):
+    """Export buttons, one row of formats per period"""
+    PERIOD_TITLES = {
+        'all': '',
+        'month': ' · month',
+        'week': ' · week',
+        'archive': ' · with archive',
+    }
 
     def __init__(self):
-        super().__init__(row_width=1)
-        self.add(InlineKeyboardButton('💾 Download as excel', callback_data='download-as-excel'))
+        super().__init__(row_width=len(EXPORTERS))
+        for period in EXPORT_PERIODS:
+            self.row(*(
+                InlineKeyboardButton(
+                    f'💾 {exporter.title}{self.PERIOD_TITLES[period]}',
+                    callback_data=export_cd.new(format=exporter.name, period=period),
+                )
+                for exporter in EXPORTERS.values()
+            ))
 
 
 class UserDisappointmentsMenuMarkup(InlineKeyboardMarkup):
@@ -77,3 +132,103 @@ class DisappointmentMenuMarkup(InlineKeyboardMarkup):
                 callback_data=delete_disappointment_cd.new(disappointment_id=disappointment_id)
             ),
         )
+
+
+class DisappointmentsPageMarkup(InlineKeyboardMarkup):
+
+    def __init__(self, page: db.DisappointmentsPage, page_cd: CallbackData):
+        super().__init__(row_width=2)
+        buttons = []
+        # A page past the deleted last rows is empty and has no row to page from
+        if not page.disappointments:
+            return
+        if page.has_previous:
+            buttons.append(self._page_button('⬅️ Previous', page_cd, 'previous', page.disappointments[0]))
+        if page.has_next:
+            buttons.append(self._page_button('Next ➡️', page_cd, 'next', page.disappointments[-1]))
+        self.add(*buttons)
+
+    @staticmethod
+    def _page_button(
+            text: str,
+            page_cd: CallbackData,
+            direction: str,
+            disappointment: db.DisappointmentRow,
+    ) -> InlineKeyboardButton:
+        return InlineKeyboardButton(
+            text=text,
+            callback_data=page_cd.new(
+                direction=direction,
+                created_at=datetime_to_microseconds(disappointment.created_at),
+                disappointment_id=disappointment.id,
+            ),
+        )
+
+
+class SearchPageMarkup(InlineKeyboardMarkup):
+
+    def __init__(self, page: db.SearchPage, page_size: int):
+        super().__init__(row_width=2)
+        buttons = []
+        if page.offset > 0:
+            buttons.append(InlineKeyboardButton(
+                '⬅️ Previous',
+                callback_data=search_page_cd.new(offset=max(page.offset - page_size, 0)),
+            ))
+        if page.has_next:
+            buttons.append(InlineKeyboardButton(
+                'Next ➡️',
+                callback_data=search_page_cd.new(offset=page.offset + page_size),
+            ))
+        self.add(*buttons)
+
+
+def serialize_markup(markup: InlineKeyboardMarkup | ReplyKeyboardMarkup) -> str:
+    """Markup as the Bot API expects it, aiogram sends strings as is without serializing them again"""
+    return json.dumps(markup.to_python())
+
+
+class UsersPickerMarkups:
+    """Serialized user picker pages, rebuilt only when the users in the cache change"""
+
+    def __init__(self, users_cache: UsersCache, page_size: int):
+        self._users_cache = users_cache
+        self._page_size = page_size
+        self._version: int | None = None
+        self._users: list[db.User] = []
+        self._pages: dict[int, str] = {}
+
+    def _sync(self) -> None:
+        if self._version == self._users_cache.version:
+            return
+        self._version = self._users_cache.version
+        self._users = sorted(self._users_cache.get_all(), key=lambda user: user.name.casefold())
+        self._pages = {}
+
+    def get_page(self, offset: int = 0) -> str:
+        self._sync()
+        offset = min(max(offset, 0), max(len(self._users) - 1, 0))
+        offset -= offset % self._page_size
+        page = self._pages.get(offset)
+        if page is None:
+            page = self._pages[offset] = serialize_markup(
+                UsersPickerMarkup(self._users, offset, self._page_size),
+            )
+        return page
+
+    def search(self, query: str) -> tuple[int, str | None]:
+        """Count users whose name contains the query, return it with a page of the first of them"""
+        self._sync()
+        query = query.casefold().strip()
+        found = [user for user in self._users if query in user.name.casefold()]
+        if not found:
+            return 0, None
+        return len(found), serialize_markup(UsersPickerMarkup(found[:self._page_size]))
+
+
+# Static markups are the same for everybody, so they are built and serialized once
+MAIN_MENU_MARKUP = serialize_markup(MainMenuMarkup())
+PROFILE_MENU_MARKUP = serialize_markup(ProfileMenuMarkup())
+DOWNLOAD_AS_EXCEL_MARKUP = serialize_markup(DownloadAsExcelMarkup())
+USER_DISAPPOINTMENTS_MENU_MARKUP = serialize_markup(UserDisappointmentsMenuMarkup())
+users_picker_markups = UsersPickerMarkups(db.users_cache, settings.USERS_PICKER_PAGE_SIZE)
@@ -1,22 +1,102 @@
 from aiogram import executor, Dispatcher
 
-import handlers
+import async_db
 import db
+import metrics
+import migrations
+import settings
+import utils
+import webhook
+import workers
 from bot import dp
-from schedulers import reset_user_points_scheduler
+from telegram_helper import notifications
+from schedulers import (
+    reset_user_points_scheduler,
+    db_pool_scheduler,
+    users_cache_scheduler,
+    fsm_storage_scheduler,
+    processed_updates_scheduler,
+    stats_scheduler,
+    disappointments_storage_scheduler,
+)
+
+
+METRICS_RUNNER_KEY = 'metrics_runner'
+WORKER_NUMBER_KEY = 'worker_number'
+
+
+def register_runtime_metrics():
+    gauges = (
+        ('bot_db_pool_idle_connections', 'Idle pooled database connections',
+         lambda: db.engine.stats().idle),
+        ('bot_db_pool_checked_out_connections', 'Database connections in use',
+         lambda: db.engine.stats().checked_out),
+        ('bot_db_pool_waiting_threads', 'Threads waiting for a database connection',
+         lambda: db.engine.stats().waiting),
+        ('bot_notifications_queue_depth', 'Notifications waiting to be sent',
+         lambda: notifications.stats().queue_depth),
+    )
+    for name, documentation, collect in gauges:
+        metrics.register(metrics.Gauge(name, documentation, collect))
+    counters = (
+        ('bot_db_pool_reconnects_total', 'Pooled database connections reopened after failing',
+         lambda: db.engine.stats().reconnects),
+        ('bot_notifications_failed_total', 'Notifications dropped after errors',
+         lambda: notifications.stats().failed),
+    )
+    for name, documentation, collect in counters:
+        metrics.register(metrics.CollectedCounter(name, documentation, collect))
 
 
 async def on_startup(dispatcher: Dispatcher):
-    db.create_tables()
-    db.insert_users()
-    reset_user_points_scheduler.start()
+    if settings.METRICS_ENABLED:
+        register_runtime_metrics()
+        # Update workers are processes of their own, each serves its metrics on the next port
+        dispatcher[METRICS_RUNNER_KEY] = await metrics.start_metrics_server(
+            settings.METRICS_HOST,
+            settings.METRICS_PORT + dispatcher.get(WORKER_NUMBER_KEY, 0),
+        )
+    await async_db.maintain_pool()
+    await async_db.run_sync(migrations.apply_migrations)
+    # Provisions users and warms the users cache, nothing touches the database at import time
+    await async_db.insert_users()
+    notifications.start()
+    if settings.POINTS_REFILL_MODE == 'reset':
+        reset_user_points_scheduler.start()
+    db_pool_scheduler.start()
+    users_cache_scheduler.start()
+    processed_updates_scheduler.start()
+    stats_scheduler.start()
+    if settings.DISAPPOINTMENTS_PARTITIONING or settings.DISAPPOINTMENTS_RETENTION_MONTHS is not None:
+        disappointments_storage_scheduler.start()
+    if settings.FSM_STORAGE == 'postgres':
+        fsm_storage_scheduler.start()
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    await notifications.close()
+    metrics_runner = dispatcher.get(METRICS_RUNNER_KEY)
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    async_db.shutdown()
 
 
 def main():
+    utils.configure_logging()
+    if settings.UPDATE_WORKERS > 1:
+        workers.run_ingest(settings.UPDATE_WORKERS)
+        return
+    # Registers the handlers on the dispatcher, imported here so importing main stays cheap
+    import handlers  # noqa: F401
+
+    if settings.BOT_MODE == 'webhook':
+        webhook.start_webhook(dp, on_startup=on_startup, on_shutdown=on_shutdown)
+        return
     executor.start_polling(
         dispatcher=dp,
-        skip_updates=True,
+        skip_updates=False,
         on_startup=on_startup,
+        on_shutdown=on_shutdown,
     )
 
 
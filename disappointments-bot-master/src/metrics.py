@@ -0,0 +1,217 @@
+import bisect
+import contextvars
+import threading
+from typing import Callable, Iterable
+
+from aiohttp import web
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERIES_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+# Notifications wait for rate limits and retries, so their latency is counted in seconds to minutes
+NOTIFICATION_LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+Labels = tuple[tuple[str, str], ...]
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        (name, value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+
+    def samples(self) -> Iterable[tuple[str, Labels, float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines += [
+            f'{name}{_format_labels(labels)} {_format_value(value)}'
+            for name, labels, value in self.samples()
+        ]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, label_name: str | None = None):
+        super().__init__(name, documentation)
+        self._label_name = label_name
+        self._values: dict[str | None, float] = {}
+
+    def inc(self, label: str | None = None, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label] = self._values.get(label, 0) + amount
+
+    def samples(self) -> Iterable[tuple[str, Labels, float]]:
+        with self._lock:
+            values = sorted(self._values.items(), key=lambda item: item[0] or '')
+        for label, value in values:
+            labels = ((self._label_name, label),) if self._label_name is not None else ()
+            yield self.name, labels, value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            label_name: str | None = None,
+            buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation)
+        self._label_name = label_name
+        self._buckets = buckets
+        # Label -> (counts per bucket with the +Inf one last, sum of observed values)
+        self._values: dict[str | None, tuple[list[int], float]] = {}
+
+    def observe(self, value: float, label: str | None = None) -> None:
+        with self._lock:
+            counts, total = self._values.get(label) or ([0] * (len(self._buckets) + 1), 0)
+            counts[bisect.bisect_left(self._buckets, value)] += 1
+            self._values[label] = counts, total + value
+
+    def count(self, label: str | None = None) -> int:
+        with self._lock:
+            counts, _ = self._values.get(label) or ((), 0)
+            return sum(counts)
+
+    def samples(self) -> Iterable[tuple[str, Labels, float]]:
+        with self._lock:
+            values = sorted(
+                ((label, (list(counts), total)) for label, (counts, total) in self._values.items()),
+                key=lambda item: item[0] or '',
+            )
+        for label, (counts, total) in values:
+            labels = ((self._label_name, label),) if self._label_name is not None else ()
+            cumulative = 0
+            for bound, count in zip((*self._buckets, '+Inf'), counts):
+                cumulative += count
+                yield f'{self.name}_bucket', (*labels, ('le', str(bound))), cumulative
+            yield f'{self.name}_sum', labels, total
+            yield f'{self.name}_count', labels, cumulative
+
+
+class Gauge(Metric):
+    """Value read from ``collect`` when metrics are scraped"""
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, collect: Callable[[], float]):
+        super().__init__(name, documentation)
+        self._collect = collect
+
+    def samples(self) -> Iterable[tuple[str, Labels, float]]:
+        yield self.name, (), self._collect()
+
+
+class CollectedCounter(Gauge):
+    """Total counted elsewhere, read from ``collect`` when metrics are scraped"""
+    type = 'counter'
+
+
+class UpdateMetrics:
+    """Measurements of the update being processed, shared with the db threads it calls"""
+
+    def __init__(self, started_at: float):
+        self.started_at = started_at
+        self.handler: str | None = None
+        self.failed = False
+        self._queries_count = 0
+        self._lock = threading.Lock()
+
+    def count_query(self) -> None:
+        with self._lock:
+            self._queries_count += 1
+
+    @property
+    def queries_count(self) -> int:
+        return self._queries_count
+
+
+current_update_metrics: contextvars.ContextVar[UpdateMetrics | None] = contextvars.ContextVar(
+    'current_update_metrics',
+    default=None,
+)
+
+_registry: list[Metric] = []
+
+
+def register(metric: Metric) -> Metric:
+    _registry.append(metric)
+    return metric
+
+
+handler_latency = register(Histogram(
+    'bot_handler_duration_seconds',
+    'Time spent processing updates by handler',
+    label_name='handler',
+))
+handler_errors = register(Counter(
+    'bot_handler_errors_total',
+    'Updates whose handler raised an exception',
+    label_name='handler',
+))
+duplicate_updates = register(Counter(
+    'bot_duplicate_updates_total',
+    'Updates dropped because they were delivered already',
+))
+db_query_latency = register(Histogram(
+    'bot_db_query_duration_seconds',
+    'Time spent executing database queries',
+))
+db_queries_per_update = register(Histogram(
+    'bot_db_queries_per_update',
+    'Database queries executed while processing one update',
+    label_name='handler',
+    buckets=QUERIES_COUNT_BUCKETS,
+))
+
+notification_latency = register(Histogram(
+    'bot_notification_latency_seconds',
+    'Time from queueing a notification to sending it',
+    buckets=NOTIFICATION_LATENCY_BUCKETS,
+))
+
+
+def observe_db_query(duration: float) -> None:
+    db_query_latency.observe(duration)
+    update_metrics = current_update_metrics.get()
+    if update_metrics is not None:
+        update_metrics.count_query()
+
+
+def render() -> str:
+    return '\n'.join(metric.render() for metric in _registry) + '\n'
+
+
+async def metrics_view(request: web.Request) -> web.Response:
+    return web.Response(body=render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_view)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
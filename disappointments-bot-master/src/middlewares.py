@@ -0,0 +1,97 @@
+import collections
+import time
+from typing import Hashable
+
+from aiogram.dispatcher.handler import CancelHandler, current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.types import Update
+
+import async_db
+import metrics
+from utils import logger
+
+UNHANDLED = 'unhandled'
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Record latency, errors and database queries count of every update by its handler"""
+
+    async def trigger(self, action, args):
+        # Handlers of every update type trigger "process_<type>" right before being called
+        if action.startswith('process_') and action not in ('process_update', 'process_error'):
+            update_metrics = metrics.current_update_metrics.get()
+            if update_metrics is not None:
+                update_metrics.handler = current_handler.get().__name__
+        return await super().trigger(action, args)
+
+    async def on_pre_process_update(self, update: Update, data: dict):
+        update_metrics = metrics.UpdateMetrics(started_at=time.perf_counter())
+        data['metrics_token'] = metrics.current_update_metrics.set(update_metrics)
+
+    async def on_pre_process_error(self, update: Update, error: BaseException, data: dict):
+        update_metrics = metrics.current_update_metrics.get()
+        if update_metrics is not None:
+            update_metrics.failed = True
+
+    async def on_post_process_update(self, update: Update, results: list, data: dict):
+        update_metrics = metrics.current_update_metrics.get()
+        if update_metrics is None:
+            return
+        metrics.current_update_metrics.reset(data.pop('metrics_token'))
+        handler = update_metrics.handler or UNHANDLED
+        metrics.handler_latency.observe(time.perf_counter() - update_metrics.started_at, handler)
+        metrics.db_queries_per_update.observe(update_metrics.queries_count, handler)
+        if update_metrics.failed:
+            metrics.handler_errors.inc(handler)
+
+
+class RecentKeys:
+    """Keys seen in the last ``ttl`` seconds, at most ``max_size`` newest of them"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self._max_size = max_size
+        self._ttl = ttl
+        # Insertion order is the order of seen times, so the oldest keys are first
+        self._seen_at: collections.OrderedDict[Hashable, float] = collections.OrderedDict()
+
+    def add(self, key: Hashable) -> bool:
+        """Remember the key, return False if it was seen already"""
+        now = time.monotonic()
+        self._evict_expired(now)
+        if key in self._seen_at:
+            return False
+        self._seen_at[key] = now
+        if len(self._seen_at) > self._max_size:
+            self._seen_at.popitem(last=False)
+        return True
+
+    def _evict_expired(self, now: float) -> None:
+        while self._seen_at:
+            key, seen_at = next(iter(self._seen_at.items()))
+            if now - seen_at <= self._ttl:
+                return
+            del self._seen_at[key]
+
+
+class UpdatesDeduplicationMiddleware(BaseMiddleware):
+    """Drop updates delivered again, recognized by update id and callback query id
+
+    Recent keys are checked in memory first. Update ids are also recorded in Postgres, so
+    updates Telegram delivers again after a restart are dropped too. An update that was being
+    processed when the bot crashed is dropped as well, rather than applied twice.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        super().__init__()
+        self._recent_keys = RecentKeys(max_size=max_size, ttl=ttl)
+
+    async def on_pre_process_update(self, update: Update, data: dict):
+        keys = [('update', update.update_id)]
+        if update.callback_query is not None:
+            keys.append(('callback_query', update.callback_query.id))
+        # Every key is remembered, so a redelivery is recognized by any of them
+        is_new = [self._recent_keys.add(key) for key in keys]
+        if not all(is_new) or not await async_db.record_processed_update(update.update_id):
+            metrics.duplicate_updates.inc()
+            logger.debug(f'Skipping duplicate update {update.update_id}')
+            raise CancelHandler()
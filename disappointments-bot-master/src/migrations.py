@@ -0,0 +1,229 @@
+import collections
+import contextlib
+from datetime import datetime
+from typing import Callable, NamedTuple
+
+from peewee import CharField, DateTimeField, Field, IntegerField, chunked
+from playhouse.migrate import PostgresqlMigrator, migrate
+
+import db
+import partitions
+from archive import iter_archived_disappointments
+import settings
+from utils import logger
+
+MIGRATIONS_LOCK_ID = 7_318_001
+
+
+class SchemaMigration(db.BaseModel):
+    version = IntegerField(primary_key=True)
+    name = CharField(max_length=255)
+    applied_at = DateTimeField(default=datetime.now)
+
+
+class Migration(NamedTuple):
+    version: int
+    apply: Callable[[], None]
+    # Statements like CREATE INDEX CONCURRENTLY can't run inside a transaction
+    atomic: bool = True
+
+
+def create_index_concurrently(model: type[db.BaseModel], *fields: Field) -> None:
+    """Build the index without blocking writes
+
+    The index is named the way peewee names ``Meta.indexes``, so fresh databases that got
+    the index from ``create_tables`` skip it.
+    """
+    table_name = model._meta.table_name
+    columns = [field.column_name for field in fields]
+    index_name = '_'.join((table_name, *columns))
+    quoted_columns = ', '.join(f'"{column}"' for column in columns)
+    db.engine.execute_sql(
+        f'CREATE INDEX CONCURRENTLY IF NOT EXISTS "{index_name}" ON "{table_name}" ({quoted_columns})'
+    )
+
+
+def add_column(model: type[db.BaseModel], field: Field) -> None:
+    """Add the column unless the table was created with it already"""
+    table_name = model._meta.table_name
+    if field.column_name in {column.name for column in db.engine.get_columns(table_name)}:
+        return
+    migrate(PostgresqlMigrator(db.engine).add_column(table_name, field.column_name, field))
+
+
+def create_initial_tables():
+    db.create_tables()
+
+
+def add_disappointment_lookup_indexes():
+    disappointment = db.Disappointment
+    create_index_concurrently(
+        disappointment,
+        disappointment.from_user,
+        disappointment.created_at,
+        disappointment.id,
+    )
+    create_index_concurrently(
+        disappointment,
+        disappointment.to_user,
+        disappointment.created_at,
+        disappointment.id,
+    )
+    create_index_concurrently(disappointment, disappointment.created_at, disappointment.id)
+
+
+def add_user_stats():
+    db.UserStats.create_table(safe=True)
+    db.reconcile_user_stats()
+
+
+def add_user_points_refill_at():
+    add_column(db.User, db.User.points_refill_at)
+
+
+def add_job_runs():
+    db.JobRun.create_table(safe=True)
+
+
+def add_daily_stats():
+    db.DailyStats.create_table(safe=True)
+    db.reconcile_daily_stats(days=None)
+
+
+def create_reason_search_index(concurrently: bool = True) -> None:
+    # The same expression as search_disappointments matches against, otherwise the index isn't used
+    db.engine.execute_sql(
+        f'CREATE INDEX {"CONCURRENTLY " if concurrently else ""}IF NOT EXISTS "disappointment_reason_search" '
+        f'ON "disappointment" USING GIN (to_tsvector(\'{db.SEARCH_TEXT_CONFIG}\', "reason"))'
+    )
+
+
+def add_disappointment_reason_search_index():
+    create_reason_search_index()
+
+
+def add_disappointments_archive():
+    db.DisappointmentArchive.create_table(safe=True)
+
+
+def add_processed_updates():
+    db.ProcessedUpdate.create_table(safe=True)
+
+
+def add_archived_user_stats():
+    """Count already archived months back into user stats, archiving used to drop them
+
+    The archive keeps names of the users and the telegram id of the receiver only, so
+    a disappointment is counted as given only if no other user has the sender's name.
+    """
+    db.ArchivedUserStats.create_table(safe=True)
+    users = list(db.User.select(db.User.id, db.User.name, db.User.telegram_id))
+    user_ids_by_telegram_id = {user.telegram_id: user.id for user in users}
+    names_count = collections.Counter(user.name for user in users)
+    user_ids_by_name = {user.name: user.id for user in users if names_count[user.name] == 1}
+    # user id -> [received count, given count, last received at]
+    stats: dict[int, list] = {}
+    for disappointment in iter_archived_disappointments():
+        to_user_id = user_ids_by_telegram_id.get(disappointment.to_user_telegram_id)
+        if to_user_id is not None:
+            user_stats = stats.setdefault(to_user_id, [0, 0, None])
+            user_stats[0] += 1
+            user_stats[2] = max(user_stats[2] or disappointment.created_at, disappointment.created_at)
+        from_user_id = user_ids_by_name.get(disappointment.from_user_name)
+        if from_user_id is not None:
+            stats.setdefault(from_user_id, [0, 0, None])[1] += 1
+    rows = ((user_id, *user_stats) for user_id, user_stats in stats.items())
+    fields = (
+        db.ArchivedUserStats.user,
+        db.ArchivedUserStats.received_count,
+        db.ArchivedUserStats.given_count,
+        db.ArchivedUserStats.last_received_at,
+    )
+    for batch in chunked(rows, 1000):
+        db.ArchivedUserStats.insert_many(batch, fields=fields).execute()
+    db.reconcile_user_stats()
+
+
+def add_changes_sequences():
+    for sequence in (db.USERS_CHANGES_SEQUENCE, db.DISAPPOINTMENTS_CHANGES_SEQUENCE):
+        db.engine.execute_sql(f'CREATE SEQUENCE IF NOT EXISTS "{sequence}"')
+
+
+MIGRATIONS = (
+    Migration(1, create_initial_tables),
+    Migration(2, add_disappointment_lookup_indexes, atomic=False),
+    Migration(3, add_user_stats),
+    Migration(4, add_user_points_refill_at),
+    Migration(5, add_job_runs),
+    Migration(6, add_daily_stats),
+    Migration(7, add_disappointment_reason_search_index, atomic=False),
+    Migration(8, add_disappointments_archive),
+    Migration(9, add_changes_sequences),
+    Migration(10, add_processed_updates),
+    Migration(11, add_archived_user_stats),
+)
+
+
+def partition_disappointments() -> None:
+    """Turn the disappointments table into one range partitioned by month of ``created_at``
+
+    Rows are copied into the new table in one transaction, the id sequence is kept.
+    Postgres requires the partition key in the primary key, so it becomes ``(id, created_at)``.
+    """
+    table_name = db.Disappointment._meta.table_name
+    old_table_name = f'{table_name}_unpartitioned'
+    user_table_name = db.User._meta.table_name
+    with db.engine.atomic():
+        db.engine.execute_sql(f'ALTER TABLE "{table_name}" RENAME TO "{old_table_name}"')
+        sequence_name = db.engine.execute_sql(
+            'SELECT pg_get_serial_sequence(%s, %s)',
+            (old_table_name, 'id'),
+        ).fetchone()[0]
+        # Otherwise the sequence is dropped together with the old table
+        db.engine.execute_sql(f'ALTER SEQUENCE {sequence_name} OWNED BY NONE')
+        db.engine.execute_sql(
+            f'CREATE TABLE "{table_name}" (LIKE "{old_table_name}" INCLUDING DEFAULTS) '
+            f'PARTITION BY RANGE ("created_at")'
+        )
+        db.engine.execute_sql(f'ALTER TABLE "{table_name}" ADD PRIMARY KEY ("id", "created_at")')
+        for column_name in ('from_user_id', 'to_user_id'):
+            db.engine.execute_sql(
+                f'ALTER TABLE "{table_name}" ADD FOREIGN KEY ("{column_name}") '
+                f'REFERENCES "{user_table_name}" ("id") ON DELETE CASCADE'
+            )
+        oldest_created_at = db.engine.execute_sql(
+            f'SELECT MIN("created_at") FROM "{old_table_name}"'
+        ).fetchone()[0]
+        month = partitions.get_month_start((oldest_created_at or datetime.now()).date())
+        while month < partitions.get_month_start(datetime.now().date()):
+            partitions.create_partition(month)
+            month = partitions.add_months(month, 1)
+        partitions.create_partitions_ahead()
+        partitions.create_default_partition()
+        db.engine.execute_sql(f'INSERT INTO "{table_name}" SELECT * FROM "{old_table_name}"')
+        db.engine.execute_sql(f'DROP TABLE "{old_table_name}"')
+        db.engine.execute_sql(f'ALTER SEQUENCE {sequence_name} OWNED BY "{table_name}"."id"')
+        # Indexes of the partitioned table are created on every partition
+        db.Disappointment._schema.create_indexes(safe=True)
+        create_reason_search_index(concurrently=False)
+    logger.info('Disappointments table is partitioned by month')
+
+
+def apply_migrations():
+    """Apply pending migrations in order, an advisory lock keeps concurrent workers from racing"""
+    db.engine.execute_sql('SELECT pg_advisory_lock(%s)', (MIGRATIONS_LOCK_ID,))
+    try:
+        SchemaMigration.create_table(safe=True)
+        applied_versions = {migration.version for migration in SchemaMigration.select()}
+        for migration in MIGRATIONS:
+            if migration.version in applied_versions:
+                continue
+            logger.info(f'Applying migration {migration.version}: {migration.apply.__name__}')
+            transaction = db.engine.atomic() if migration.atomic else contextlib.nullcontext()
+            with transaction:
+                migration.apply()
+                SchemaMigration.create(version=migration.version, name=migration.apply.__name__)
+        if settings.DISAPPOINTMENTS_PARTITIONING and not partitions.is_partitioned():
+            partition_disappointments()
+    finally:
+        db.engine.execute_sql('SELECT pg_advisory_unlock(%s)', (MIGRATIONS_LOCK_ID,))
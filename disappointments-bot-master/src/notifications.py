@@ -0,0 +1,220 @@
+import asyncio
+import collections
+import statistics
+from typing import NamedTuple
+
+from aiogram import Bot
+from aiogram.types import InlineKeyboardMarkup
+from aiogram.utils.exceptions import (
+    TelegramAPIError,
+    RetryAfter,
+    NetworkError,
+    RestartingTelegram,
+)
+
+import metrics
+from utils import logger
+
+TRANSIENT_ERRORS = (NetworkError, RestartingTelegram, asyncio.TimeoutError)
+
+
+class Notification(NamedTuple):
+    chat_id: int
+    text: str
+    reply_markup: InlineKeyboardMarkup | None
+    enqueued_at: float
+    attempt: int = 0
+
+
+class NotificationsStats(NamedTuple):
+    queue_depth: int
+    chats_waiting: int
+    sent: int
+    coalesced: int
+    retried: int
+    failed: int
+    latency_p50: float | None
+    latency_p99: float | None
+
+
+class RateLimiter:
+    """Token bucket allowing ``rate`` acquisitions per second with bursts up to ``burst``"""
+
+    def __init__(self, rate: float, burst: int):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated_at: float | None = None
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self._updated_at is not None:
+                self._tokens = min(self._burst, self._tokens + (now - self._updated_at) * self._rate)
+            self._updated_at = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
+
+class NotificationDispatcher:
+    """Background queue sending notifications within Telegram rate limits
+
+    Notifications for the same chat that pile up while the chat waits for its turn are
+    coalesced into one message. Flood control and network errors are retried with backoff.
+    """
+
+    def __init__(
+            self,
+            bot: Bot,
+            *,
+            global_rate: float,
+            chat_interval: float,
+            workers_count: int,
+            max_attempts: int,
+            coalesce_limit: int,
+    ):
+        self._bot = bot
+        self._global_rate_limiter = RateLimiter(rate=global_rate, burst=max(int(global_rate), 1))
+        self._chat_interval = chat_interval
+        self._workers_count = workers_count
+        self._max_attempts = max_attempts
+        self._coalesce_limit = coalesce_limit
+        self._pending: dict[int, collections.deque[Notification]] = {}
+        self._chat_available_at: dict[int, float] = {}
+        self._ready_chats: asyncio.Queue[int] | None = None
+        self._workers: list[asyncio.Task] = []
+        self._latencies: collections.deque[float] = collections.deque(maxlen=1000)
+        self._sent = 0
+        self._coalesced = 0
+        self._retried = 0
+        self._failed = 0
+
+    def start(self) -> None:
+        self._ready_chats = asyncio.Queue()
+        self._workers = [
+            asyncio.create_task(self._work(), name=f'notifications-worker-{number}')
+            for number in range(self._workers_count)
+        ]
+
+    async def close(self, timeout: float = 10) -> None:
+        """Give queued notifications ``timeout`` seconds to be sent and stop the workers"""
+        if self._ready_chats is not None:
+            try:
+                await asyncio.wait_for(self._ready_chats.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f'Dropping {self.stats().queue_depth} unsent notifications')
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def notify(
+            self,
+            chat_id: int,
+            text: str,
+            reply_markup: InlineKeyboardMarkup | None = None,
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        self._enqueue(Notification(chat_id, text, reply_markup, enqueued_at=loop.time()))
+
+    def _enqueue(self, notification: Notification, first: bool = False) -> None:
+        pending = self._pending.get(notification.chat_id)
+        if pending is None:
+            pending = self._pending[notification.chat_id] = collections.deque()
+            self._ready_chats.put_nowait(notification.chat_id)
+        if first:
+            pending.appendleft(notification)
+        else:
+            pending.append(notification)
+
+    async def _work(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            chat_id = await self._ready_chats.get()
+            try:
+                delay = self._chat_available_at.get(chat_id, 0) - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await self._global_rate_limiter.acquire()
+                await self._send_pending(chat_id)
+            except Exception:
+                logger.exception(f'Failed to send notifications to chat {chat_id}')
+            finally:
+                self._ready_chats.task_done()
+
+    def _take_batch(self, chat_id: int) -> list[Notification]:
+        pending = self._pending[chat_id]
+        batch = [pending.popleft() for _ in range(min(len(pending), self._coalesce_limit))]
+        if pending:
+            self._ready_chats.put_nowait(chat_id)
+        else:
+            del self._pending[chat_id]
+        return batch
+
+    async def _send_pending(self, chat_id: int) -> None:
+        loop = asyncio.get_running_loop()
+        batch = self._take_batch(chat_id)
+        self._chat_available_at[chat_id] = loop.time() + self._chat_interval
+        text, reply_markup = coalesce(batch)
+        try:
+            await self._bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup)
+        except RetryAfter as error:
+            self._chat_available_at[chat_id] = loop.time() + error.timeout
+            self._retry(batch, backoff=None)
+        except TRANSIENT_ERRORS as error:
+            logger.warning(f'Notification to chat {chat_id} failed: {error!r}')
+            self._retry(batch, backoff=2 ** max(notification.attempt for notification in batch))
+        except TelegramAPIError as error:
+            logger.warning(f'Notification to chat {chat_id} dropped: {error!r}')
+            self._failed += len(batch)
+        else:
+            self._sent += 1
+            self._coalesced += len(batch) - 1
+            for notification in batch:
+                latency = loop.time() - notification.enqueued_at
+                self._latencies.append(latency)
+                metrics.notification_latency.observe(latency)
+
+    def _retry(self, batch: list[Notification], backoff: float | None) -> None:
+        loop = asyncio.get_running_loop()
+        retried = [notification._replace(attempt=notification.attempt + 1) for notification in batch]
+        exhausted = [notification for notification in retried if notification.attempt >= self._max_attempts]
+        if exhausted:
+            logger.warning(f'Dropping {len(exhausted)} notifications after {self._max_attempts} attempts')
+            self._failed += len(exhausted)
+        chat_id = batch[0].chat_id
+        if backoff is not None:
+            self._chat_available_at[chat_id] = loop.time() + backoff
+        for notification in reversed(retried):
+            if notification.attempt < self._max_attempts:
+                self._retried += 1
+                self._enqueue(notification, first=True)
+
+    def stats(self) -> NotificationsStats:
+        latencies = sorted(self._latencies)
+        return NotificationsStats(
+            queue_depth=sum(len(pending) for pending in self._pending.values()),
+            chats_waiting=len(self._pending),
+            sent=self._sent,
+            coalesced=self._coalesced,
+            retried=self._retried,
+            failed=self._failed,
+            latency_p50=statistics.median(latencies) if latencies else None,
+            latency_p99=latencies[int(len(latencies) * 0.99)] if latencies else None,
+        )
+
+
+def coalesce(notifications: list[Notification]) -> tuple[str, InlineKeyboardMarkup | None]:
+    """Merge notifications into one message, repeated texts are shown once"""
+    texts = list(dict.fromkeys(notification.text for notification in notifications))
+    keyboard = [
+        row
+        for notification in notifications
+        if notification.reply_markup is not None
+        for row in notification.reply_markup.inline_keyboard
+    ]
+    reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard) if keyboard else None
+    return '\n\n'.join(texts), reply_markup
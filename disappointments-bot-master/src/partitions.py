@@ -0,0 +1,68 @@
+from datetime import date, datetime, time
+
+import db
+import settings
+from utils import logger
+
+DEFAULT_PARTITION_NAME = 'disappointment_default'
+
+
+def get_month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def add_months(month: date, months: int) -> date:
+    month_index = month.year * 12 + month.month - 1 + months
+    return date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def get_month_bounds(month: date) -> tuple[datetime, datetime]:
+    """Start of the month and start of the next one, as ``created_at`` values"""
+    return datetime.combine(month, time()), datetime.combine(add_months(month, 1), time())
+
+
+def get_partition_name(month: date) -> str:
+    return f'disappointment_y{month:%Y}m{month:%m}'
+
+
+def is_partitioned() -> bool:
+    table_name = db.Disappointment._meta.table_name
+    cursor = db.engine.execute_sql(
+        'SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s))',
+        (table_name,),
+    )
+    return cursor.fetchone()[0]
+
+
+def partition_exists(month: date) -> bool:
+    cursor = db.engine.execute_sql('SELECT to_regclass(%s) IS NOT NULL', (get_partition_name(month),))
+    return cursor.fetchone()[0]
+
+
+def create_partition(month: date) -> None:
+    start, end = get_month_bounds(month)
+    db.engine.execute_sql(
+        f'CREATE TABLE IF NOT EXISTS "{get_partition_name(month)}" '
+        f'PARTITION OF "{db.Disappointment._meta.table_name}" FOR VALUES FROM (%s) TO (%s)',
+        (start, end),
+    )
+
+
+def create_default_partition() -> None:
+    """Takes rows of months without a partition, so inserts never fail on a missing one"""
+    db.engine.execute_sql(
+        f'CREATE TABLE IF NOT EXISTS "{DEFAULT_PARTITION_NAME}" '
+        f'PARTITION OF "{db.Disappointment._meta.table_name}" DEFAULT'
+    )
+
+
+def drop_partition(month: date) -> None:
+    db.engine.execute_sql(f'DROP TABLE IF EXISTS "{get_partition_name(month)}"')
+
+
+def create_partitions_ahead(months_ahead: int = settings.DISAPPOINTMENTS_PARTITIONS_AHEAD) -> None:
+    """Create partitions of the current month and ``months_ahead`` next ones"""
+    current_month = get_month_start(date.today())
+    for number in range(months_ahead + 1):
+        create_partition(add_months(current_month, number))
+    logger.debug(f'Disappointment partitions are created {months_ahead} months ahead')
@@ -1,11 +1,66 @@
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 
+import archive
+import async_db
 import db
+import settings
+from exclusive_jobs import ExclusiveJob
 
 __all__ = (
     'reset_user_points_scheduler',
+    'db_pool_scheduler',
+    'users_cache_scheduler',
+    'fsm_storage_scheduler',
+    'processed_updates_scheduler',
+    'stats_scheduler',
+    'disappointments_storage_scheduler',
 )
 
+reset_user_points_job = ExclusiveJob(
+    'reset_user_points',
+    db.reset_user_points,
+    CronTrigger(hour=f'*/{settings.POINTS_REFILL_HOURS}'),
+    sync=db.refresh_users_cache,
+)
 reset_user_points_scheduler = AsyncIOScheduler()
-reset_user_points_scheduler.add_job(db.reset_user_points, CronTrigger(hour='*/3'))
+reset_user_points_job.schedule(reset_user_points_scheduler)
+
+db_pool_scheduler = AsyncIOScheduler()
+db_pool_scheduler.add_job(async_db.maintain_pool, IntervalTrigger(minutes=1))
+
+# Users imported or renamed in another worker process are picked up by this sync
+users_cache_scheduler = AsyncIOScheduler()
+users_cache_scheduler.add_job(
+    async_db.sync_users_cache,
+    IntervalTrigger(seconds=settings.USERS_CACHE_SYNC_INTERVAL),
+)
+
+fsm_storage_scheduler = AsyncIOScheduler()
+fsm_storage_scheduler.add_job(async_db.delete_expired_fsm_records, IntervalTrigger(hours=1))
+
+processed_updates_scheduler = AsyncIOScheduler()
+processed_updates_scheduler.add_job(async_db.delete_expired_processed_updates, IntervalTrigger(hours=1))
+
+reconcile_user_stats_job = ExclusiveJob(
+    'reconcile_user_stats',
+    db.reconcile_user_stats,
+    CronTrigger(hour=4),
+)
+reconcile_daily_stats_job = ExclusiveJob(
+    'reconcile_daily_stats',
+    db.reconcile_daily_stats,
+    CronTrigger(hour=4, minute=30),
+)
+stats_scheduler = AsyncIOScheduler()
+reconcile_user_stats_job.schedule(stats_scheduler)
+reconcile_daily_stats_job.schedule(stats_scheduler)
+
+maintain_disappointments_storage_job = ExclusiveJob(
+    'maintain_disappointments_storage',
+    archive.maintain_disappointments_storage,
+    CronTrigger(hour=3),
+)
+disappointments_storage_scheduler = AsyncIOScheduler()
+maintain_disappointments_storage_job.schedule(disappointments_storage_scheduler)
@@ -0,0 +1,63 @@
+from datetime import date, datetime, time, timedelta
+from typing import Iterable, NamedTuple, TYPE_CHECKING
+
+from exceptions import InvalidSearchQuery
+
+if TYPE_CHECKING:
+    from db import User
+
+DATE_FORMATS = ('%d.%m.%Y', '%Y-%m-%d')
+SEARCH_HELP = ('Send /search with words of the reason and filters, for example:\n'
+               '/search late meeting from:Eldos to:Rustam since:01.09.2024 until:30.09.2024\n'
+               'Use _ instead of spaces in names')
+
+
+class SearchQuery(NamedTuple):
+    text: str
+    from_user_id: int | None = None
+    to_user_id: int | None = None
+    since: datetime | None = None
+    until: datetime | None = None
+
+    def is_empty(self) -> bool:
+        return self == SearchQuery(text='')
+
+
+def _parse_date(value: str) -> date:
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    raise InvalidSearchQuery(f'"{value}" is not a date, use DD.MM.YYYY')
+
+
+def _find_user_id(name: str, users: Iterable['User']) -> int:
+    for user in users:
+        if user.name.casefold().replace(' ', '_') == name.casefold():
+            return user.id
+    raise InvalidSearchQuery(f'There is no user "{name}"')
+
+
+def parse_search_query(query: str, users: Iterable['User']) -> SearchQuery:
+    """Split ``from:``, ``to:``, ``since:`` and ``until:`` filters from the words to search for
+
+    Dates are inclusive, so ``until:`` takes the whole day.
+    """
+    users = list(users)
+    words = []
+    filters = {}
+    for word in query.split():
+        key, separator, value = word.partition(':')
+        key = key.lower()
+        if not separator or not value or key not in ('from', 'to', 'since', 'until'):
+            words.append(word)
+        elif key == 'from':
+            filters['from_user_id'] = _find_user_id(value, users)
+        elif key == 'to':
+            filters['to_user_id'] = _find_user_id(value, users)
+        elif key == 'since':
+            filters['since'] = datetime.combine(_parse_date(value), time())
+        else:
+            filters['until'] = datetime.combine(_parse_date(value) + timedelta(days=1), time())
+    return SearchQuery(text=' '.join(words), **filters)
@@ -8,8 +8,69 @@ env.read_env()
 
 SRC_DIR = pathlib.Path(__file__).parent
 POINTS_AMOUNT: int = env.int('POINTS_AMOUNT')
+# 'reset' gives everybody full points every POINTS_REFILL_HOURS,
+# 'rolling' gives user's points back POINTS_REFILL_HOURS after they started spending them
+POINTS_REFILL_MODE: str = env.str('POINTS_REFILL_MODE', 'reset')
+POINTS_REFILL_HOURS: int = env.int('POINTS_REFILL_HOURS', 3)
 TELEGRAM_BOT_TOKEN: str = env.str('TELEGRAM_BOT_TOKEN')
+ADMIN_TELEGRAM_IDS: list[int] = env.list('ADMIN_TELEGRAM_IDS', [], subcast=int)
 DATABASE = urllib.parse.urlparse(env.str('DATABASE_URL'))
 DEBUG: bool = env.bool('DEBUG')
+DB_MIN_CONNECTIONS: int = env.int('DB_MIN_CONNECTIONS', 1)
+DB_MAX_CONNECTIONS: int = env.int('DB_MAX_CONNECTIONS', 10)
+DB_CONNECTION_IDLE_TIMEOUT: int = env.int('DB_CONNECTION_IDLE_TIMEOUT', 300)
+DB_CONNECTION_MAX_AGE: int = env.int('DB_CONNECTION_MAX_AGE', 1800)
+DB_CONNECTION_WAIT_TIMEOUT: int = env.int('DB_CONNECTION_WAIT_TIMEOUT', 10)
+DB_CONNECTION_PRE_PING: bool = env.bool('DB_CONNECTION_PRE_PING', True)
+DB_SLOW_QUERY_THRESHOLD: float = env.float('DB_SLOW_QUERY_THRESHOLD', 0.5)
 
-REPORT_FILE_PATH = './disappointments-report.xlsx'
+FSM_STORAGE: str = env.str('FSM_STORAGE', 'postgres')
+FSM_STATE_TTL: int = env.int('FSM_STATE_TTL', 24 * 60 * 60)
+
+NOTIFICATIONS_GLOBAL_RATE: float = env.float('NOTIFICATIONS_GLOBAL_RATE', 25)
+NOTIFICATIONS_CHAT_INTERVAL: float = env.float('NOTIFICATIONS_CHAT_INTERVAL', 1)
+NOTIFICATIONS_WORKERS_COUNT: int = env.int('NOTIFICATIONS_WORKERS_COUNT', 8)
+NOTIFICATIONS_MAX_ATTEMPTS: int = env.int('NOTIFICATIONS_MAX_ATTEMPTS', 5)
+NOTIFICATIONS_COALESCE_LIMIT: int = env.int('NOTIFICATIONS_COALESCE_LIMIT', 10)
+
+BOT_MODE: str = env.str('BOT_MODE', 'polling')
+WEBHOOK_URL: str | None = env.str('WEBHOOK_URL', None)
+WEBHOOK_PATH: str = env.str('WEBHOOK_PATH', '/webhook')
+WEBHOOK_HOST: str = env.str('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT: int = env.int('WEBHOOK_PORT', 8080)
+WEBHOOK_SECRET_TOKEN: str | None = env.str('WEBHOOK_SECRET_TOKEN', None)
+WEBHOOK_MAX_CONNECTIONS: int = env.int('WEBHOOK_MAX_CONNECTIONS', 40)
+WEBHOOK_MAX_IN_FLIGHT_UPDATES: int = env.int('WEBHOOK_MAX_IN_FLIGHT_UPDATES', 100)
+# With more than one, an ingest process shards updates by chat to this many worker processes
+UPDATE_WORKERS: int = env.int('UPDATE_WORKERS', 1)
+WORKER_MAX_IN_FLIGHT_UPDATES: int = env.int('WORKER_MAX_IN_FLIGHT_UPDATES', 100)
+
+UPDATES_DEDUPLICATION_SIZE: int = env.int('UPDATES_DEDUPLICATION_SIZE', 10000)
+UPDATES_DEDUPLICATION_TTL: int = env.int('UPDATES_DEDUPLICATION_TTL', 60 * 60)
+
+METRICS_ENABLED: bool = env.bool('METRICS_ENABLED', True)
+METRICS_HOST: str = env.str('METRICS_HOST', '127.0.0.1')
+METRICS_PORT: int = env.int('METRICS_PORT', 9090)
+
+USERS_FILE: str | None = env.str('USERS_FILE', None)
+USERS_IMPORT_BATCH_SIZE: int = env.int('USERS_IMPORT_BATCH_SIZE', 1000)
+USERS_IMPORT_MAX_FILE_SIZE: int = env.int('USERS_IMPORT_MAX_FILE_SIZE', 5 * 1024 * 1024)
+# Telegram limits inline keyboards to 100 buttons
+USERS_PICKER_PAGE_SIZE: int = env.int('USERS_PICKER_PAGE_SIZE', 20)
+# How often the users cache is reloaded if another process changed users, seconds
+USERS_CACHE_SYNC_INTERVAL: int = env.int('USERS_CACHE_SYNC_INTERVAL', 10)
+
+DISAPPOINTMENTS_PAGE_SIZE: int = env.int('DISAPPOINTMENTS_PAGE_SIZE', 10)
+EXPORT_CHUNK_SIZE: int = env.int('EXPORT_CHUNK_SIZE', 1000)
+SEARCH_PAGE_SIZE: int = env.int('SEARCH_PAGE_SIZE', 10)
+# Telegram shows at most 50 inline query results at once
+SEARCH_INLINE_PAGE_SIZE: int = env.int('SEARCH_INLINE_PAGE_SIZE', 20)
+STATS_LEADERBOARD_SIZE: int = env.int('STATS_LEADERBOARD_SIZE', 5)
+STATS_TREND_DAYS: int = env.int('STATS_TREND_DAYS', 7)
+STATS_TREND_WEEKS: int = env.int('STATS_TREND_WEEKS', 8)
+DAILY_STATS_RECONCILE_DAYS: int = env.int('DAILY_STATS_RECONCILE_DAYS', 31)
+# Monthly range partitions of disappointments by created_at, the table is converted on startup
+DISAPPOINTMENTS_PARTITIONING: bool = env.bool('DISAPPOINTMENTS_PARTITIONING', False)
+DISAPPOINTMENTS_PARTITIONS_AHEAD: int = env.int('DISAPPOINTMENTS_PARTITIONS_AHEAD', 2)
+# Months older than this are moved to the compressed archive, kept forever when not set
+DISAPPOINTMENTS_RETENTION_MONTHS: int | None = env.int('DISAPPOINTMENTS_RETENTION_MONTHS', None)
@@ -1,27 +1,36 @@
-import contextlib
-
 from aiogram.types import InlineKeyboardMarkup
-from aiogram.utils.exceptions import TelegramAPIError
+from aiogram.utils.markdown import markdown_decoration
 
 import db
+import settings
 from bot import bot
 from keyboards import ViewDisappointmentButton
+from notifications import NotificationDispatcher
+
+notifications = NotificationDispatcher(
+    bot,
+    # Every update worker sends its own notifications, together they keep the global rate
+    global_rate=settings.NOTIFICATIONS_GLOBAL_RATE / settings.UPDATE_WORKERS,
+    chat_interval=settings.NOTIFICATIONS_CHAT_INTERVAL,
+    workers_count=settings.NOTIFICATIONS_WORKERS_COUNT,
+    max_attempts=settings.NOTIFICATIONS_MAX_ATTEMPTS,
+    coalesce_limit=settings.NOTIFICATIONS_COALESCE_LIMIT,
+)
 
 
-async def notify_new_disappointment(user: db.User, disappointment_id: int):
-    with contextlib.suppress(TelegramAPIError):
-        await bot.send_message(
-            chat_id=user.telegram_id,
-            text='⚡️ You got new disappointment',
-            reply_markup=InlineKeyboardMarkup().add(ViewDisappointmentButton(disappointment_id)),
-        )
+def notify_new_disappointment(user: db.User, disappointment_id: int):
+    notifications.notify(
+        chat_id=user.telegram_id,
+        text='⚡️ You got new disappointment',
+        reply_markup=InlineKeyboardMarkup().add(ViewDisappointmentButton(disappointment_id)),
+    )
 
 
-async def notify_deleted_disappointment(disappointment: db.Disappointment):
-    text = (f'Disappointment from user *{disappointment.from_user.name}*'
-            f' with reason _{disappointment.reason}_ has been deleted')
-    with contextlib.suppress(TelegramAPIError):
-        await bot.send_message(
-            chat_id=disappointment.to_user.telegram_id,
-            text=text
-        )
+def notify_deleted_disappointment(disappointment: db.DisappointmentRow):
+    # Texts are coalesced into one MarkdownV2 message, an unescaped one would drop the others with it
+    text = (f'Disappointment from user *{markdown_decoration.quote(disappointment.from_user_name)}*'
+            f' with reason _{markdown_decoration.quote(disappointment.reason)}_ has been deleted')
+    notifications.notify(
+        chat_id=disappointment.to_user_telegram_id,
+        text=text,
+    )
@@ -0,0 +1,55 @@
+import threading
+from datetime import datetime
+from typing import Iterable, TYPE_CHECKING
+
+from exceptions import UserDoesNotExist
+
+if TYPE_CHECKING:
+    from db import User
+
+
+class UsersCache:
+    """In-process maps of users by telegram id and by id
+
+    The maps are replaced as a whole on every load, so readers never see a half-filled cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_telegram_id: dict[int, 'User'] = {}
+        self._by_id: dict[int, 'User'] = {}
+        self.version = 0
+
+    def load(self, users: Iterable['User']) -> None:
+        users = list(users)
+        by_telegram_id = {user.telegram_id: user for user in users}
+        by_id = {user.id: user for user in users}
+        with self._lock:
+            self._by_telegram_id = by_telegram_id
+            self._by_id = by_id
+            self.version += 1
+
+    def has_telegram_id(self, telegram_id: int) -> bool:
+        return telegram_id in self._by_telegram_id
+
+    def get_by_telegram_id(self, telegram_id: int) -> 'User':
+        try:
+            return self._by_telegram_id[telegram_id]
+        except KeyError:
+            raise UserDoesNotExist
+
+    def get_by_id(self, user_id: int | str) -> 'User':
+        try:
+            return self._by_id[int(user_id)]
+        except (KeyError, ValueError):
+            raise UserDoesNotExist
+
+    def get_all(self) -> list['User']:
+        return list(self._by_id.values())
+
+    def set_points(self, user_id: int, points: int, points_refill_at: datetime | None = None) -> None:
+        user = self._by_id.get(user_id)
+        if user is not None:
+            user.points = points
+            user.points_refill_at = points_refill_at
+
@@ -0,0 +1,42 @@
+import csv
+import io
+import json
+import pathlib
+from typing import NamedTuple
+
+from exceptions import InvalidUsersFile
+
+NAME_MAX_LENGTH = 255
+
+
+class UserData(NamedTuple):
+    name: str
+    telegram_id: int
+
+
+def parse_users(content: bytes, file_name: str) -> list[UserData]:
+    """Read users from a CSV file with name and telegram_id columns or a JSON list of such objects"""
+    suffix = pathlib.PurePath(file_name).suffix.lower()
+    if suffix not in ('.csv', '.json'):
+        raise InvalidUsersFile(f'Unsupported file type "{suffix}", send a .csv or .json file')
+    try:
+        text = content.decode('utf-8-sig')
+        if suffix == '.json':
+            rows = json.loads(text)
+        else:
+            rows = list(csv.DictReader(io.StringIO(text)))
+        users = [
+            UserData(name=str(row['name']).strip(), telegram_id=int(row['telegram_id']))
+            for row in rows
+        ]
+    except (ValueError, KeyError, TypeError) as error:
+        raise InvalidUsersFile(f'Users must have "name" and integer "telegram_id" fields: {error}')
+    for user in users:
+        if not 0 < len(user.name) <= NAME_MAX_LENGTH:
+            raise InvalidUsersFile(f'User {user.telegram_id} must have a name of 1-{NAME_MAX_LENGTH} characters')
+    return users
+
+
+def read_users_file(path: str | pathlib.Path) -> list[UserData]:
+    path = pathlib.Path(path)
+    return parse_users(path.read_bytes(), path.name)
@@ -1,6 +1,5 @@
 import logging
-import itertools
-from typing import Iterable, Generator, Any
+from datetime import datetime, timedelta
 
 from aiogram.types import Message, CallbackQuery
 
@@ -8,16 +7,22 @@ import settings
 
 LOG_LEVEL = logging.DEBUG if settings.DEBUG else logging.WARNING
 
-logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger()
 
+EPOCH = datetime(1970, 1, 1)
+
+
+def configure_logging() -> None:
+    logging.basicConfig(level=LOG_LEVEL)
+
 
 def get_user_id(query: Message | CallbackQuery) -> int:
     return query.from_user.id
 
 
-def gen_group_items(iterable: Iterable, group_by: int) -> Generator[Any, None, None]:
-    """Collect data into non-overlapping fixed-length chunks or blocks"""
-    args = [iter(iterable)] * group_by
-    return ((i for i in group if i is not None)
-            for group in itertools.zip_longest(*args, fillvalue=None))
+def datetime_to_microseconds(value: datetime) -> int:
+    return (value - EPOCH) // timedelta(microseconds=1)
+
+
+def microseconds_to_datetime(value: int | str) -> datetime:
+    return EPOCH + timedelta(microseconds=int(value))
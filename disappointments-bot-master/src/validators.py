@@ -3,5 +3,5 @@ import exceptions
 
 
 def check_user_has_enough_points(user: db.User):
-    if user.points <= 0:
+    if user.get_available_points() <= 0:
         raise exceptions.UserHasNotEnoughPoints
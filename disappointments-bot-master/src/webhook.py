@@ -0,0 +1,99 @@
+import asyncio
+import hmac
+from typing import Awaitable, Callable
+
+from aiogram import Dispatcher
+from aiogram.dispatcher.webhook import WebhookRequestHandler
+from aiogram.types import Update
+from aiogram.utils.executor import Executor
+from aiohttp import web
+
+import settings
+from utils import logger
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+UPDATES_SEMAPHORE_KEY = 'UPDATES_SEMAPHORE'
+IN_FLIGHT_UPDATES_KEY = 'IN_FLIGHT_UPDATES'
+
+DispatcherCallback = Callable[[Dispatcher], Awaitable]
+
+
+class BoundedWebhookRequestHandler(WebhookRequestHandler):
+    """Acknowledges updates right away and processes them concurrently in background
+
+    At most ``WEBHOOK_MAX_IN_FLIGHT_UPDATES`` updates are processed at once. Further requests
+    wait for a free slot before being acknowledged, so Telegram slows down the delivery.
+    """
+
+    async def post(self):
+        self.validate_ip()
+        self.validate_secret_token()
+        dispatcher = self.get_dispatcher()
+        update = await self.parse_update(dispatcher.bot)
+
+        semaphore: asyncio.Semaphore = self.request.app[UPDATES_SEMAPHORE_KEY]
+        in_flight_updates: set[asyncio.Task] = self.request.app[IN_FLIGHT_UPDATES_KEY]
+        await semaphore.acquire()
+        task = asyncio.create_task(process_update(dispatcher, update))
+        in_flight_updates.add(task)
+        task.add_done_callback(in_flight_updates.discard)
+        task.add_done_callback(lambda _: semaphore.release())
+        return web.Response(text='ok')
+
+    def validate_secret_token(self):
+        validate_secret_token(self.request)
+
+
+def validate_secret_token(request: web.Request) -> None:
+    if settings.WEBHOOK_SECRET_TOKEN is None:
+        return
+    secret_token = request.headers.get(SECRET_TOKEN_HEADER, '')
+    if not hmac.compare_digest(secret_token.encode(), settings.WEBHOOK_SECRET_TOKEN.encode()):
+        logger.warning('Blocking webhook request with invalid secret token')
+        raise web.HTTPUnauthorized()
+
+
+async def process_update(dispatcher: Dispatcher, update: Update) -> None:
+    try:
+        await dispatcher.updates_handler.notify(update)
+    except Exception:
+        logger.exception(f'Failed to process update {update.update_id}')
+
+
+async def register_webhook(dispatcher: Dispatcher) -> None:
+    if settings.WEBHOOK_URL is None:
+        logger.warning('WEBHOOK_URL is not set, webhook is not registered in Telegram')
+        return
+    await dispatcher.bot.set_webhook(
+        settings.WEBHOOK_URL,
+        secret_token=settings.WEBHOOK_SECRET_TOKEN,
+        max_connections=settings.WEBHOOK_MAX_CONNECTIONS,
+        drop_pending_updates=False,
+    )
+
+
+async def wait_in_flight_updates(app: web.Application) -> None:
+    in_flight_updates: set[asyncio.Task] = app[IN_FLIGHT_UPDATES_KEY]
+    if in_flight_updates:
+        await asyncio.wait(in_flight_updates)
+
+
+def start_webhook(
+        dispatcher: Dispatcher,
+        on_startup: DispatcherCallback,
+        on_shutdown: DispatcherCallback,
+) -> None:
+    app = web.Application()
+    app[UPDATES_SEMAPHORE_KEY] = asyncio.Semaphore(settings.WEBHOOK_MAX_IN_FLIGHT_UPDATES)
+    app[IN_FLIGHT_UPDATES_KEY] = set()
+    app.on_shutdown.append(wait_in_flight_updates)
+
+    executor = Executor(dispatcher)
+    executor.on_startup([on_startup, register_webhook], polling=False)
+    executor.on_shutdown(on_shutdown, polling=False)
+    executor.set_webhook(
+        settings.WEBHOOK_PATH,
+        request_handler=BoundedWebhookRequestHandler,
+        web_app=app,
+    )
+    executor.run_app(host=settings.WEBHOOK_HOST, port=settings.WEBHOOK_PORT)
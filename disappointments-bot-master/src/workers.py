@@ -0,0 +1,211 @@
+import asyncio
+import contextlib
+import multiprocessing
+import signal
+from multiprocessing.process import BaseProcess
+from multiprocessing.queues import Queue
+
+from aiogram import Bot, Dispatcher
+from aiogram.bot.api import Methods
+from aiogram.types import Update
+from aiogram.utils.payload import generate_payload
+from aiohttp import web
+
+import settings
+import utils
+import webhook
+from bot import bot, dp
+from utils import logger
+
+POLLING_TIMEOUT = 20
+POLLING_RETRY_DELAY = 5
+WORKERS_CHECK_INTERVAL = 1
+CHAT_UPDATE_KINDS = ('message', 'edited_message', 'channel_post', 'edited_channel_post')
+
+
+def get_shard_key(update: dict) -> int:
+    """Chat id of the update, or id of the user when it has no chat
+
+    Updates of one chat always go to the same worker, so its FSM state and order are kept.
+    """
+    for kind in CHAT_UPDATE_KINDS:
+        if kind in update:
+            return update[kind]['chat']['id']
+    callback_query = update.get('callback_query')
+    if callback_query is not None and callback_query.get('message') is not None:
+        return callback_query['message']['chat']['id']
+    for payload in update.values():
+        if isinstance(payload, dict) and 'from' in payload:
+            return payload['from']['id']
+    return update['update_id']
+
+
+class UpdateWorkers:
+    """Worker processes with a queue of updates each, updates are routed to them by chat
+
+    A worker that died is started again on the same queue, so its chats are answered again
+    and its queue doesn't grow while nobody reads it.
+    """
+
+    def __init__(self, count: int):
+        # Spawned workers open their own database connections instead of sharing the forked ones
+        self._context = multiprocessing.get_context('spawn')
+        self._queues: list[Queue] = [self._context.Queue() for _ in range(count)]
+        self._processes: list[BaseProcess] = [self._start_worker(number) for number in range(count)]
+
+    def _start_worker(self, number: int) -> BaseProcess:
+        process = self._context.Process(
+            target=run_worker,
+            args=(number, self._queues[number]),
+            name=f'update-worker-{number}',
+        )
+        process.start()
+        return process
+
+    def put(self, update: dict) -> None:
+        # Queues are unbounded, so put never blocks and updates of a chat keep their order
+        self._queues[get_shard_key(update) % len(self._queues)].put(update)
+
+    def restart_dead_workers(self) -> None:
+        for number, process in enumerate(self._processes):
+            if process.is_alive():
+                continue
+            logger.error(f'Update worker {number} died with exit code {process.exitcode}, restarting it')
+            self._processes[number] = self._start_worker(number)
+
+    def stop(self) -> None:
+        for queue in self._queues:
+            queue.put(None)
+        for process in self._processes:
+            process.join()
+
+
+async def watch_workers(workers: UpdateWorkers) -> None:
+    while True:
+        await asyncio.sleep(WORKERS_CHECK_INTERVAL)
+        workers.restart_dead_workers()
+
+
+async def poll_updates(workers: UpdateWorkers) -> None:
+    """Long poll raw updates, they are parsed only by the worker that processes them"""
+    offset = None
+    while True:
+        try:
+            # The offset is left out until the first updates arrive, None would be sent as a literal value
+            payload = generate_payload(offset=offset, timeout=POLLING_TIMEOUT)
+            updates = await bot.request(Methods.GET_UPDATES, payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception('Failed to get updates')
+            await asyncio.sleep(POLLING_RETRY_DELAY)
+            continue
+        for update in updates:
+            workers.put(update)
+            offset = update['update_id'] + 1
+
+
+async def start_ingest_webhook(workers: UpdateWorkers) -> web.AppRunner:
+
+    async def handle_update(request: web.Request) -> web.Response:
+        webhook.validate_secret_token(request)
+        workers.put(await request.json())
+        return web.Response(text='ok')
+
+    app = web.Application()
+    app.router.add_post(settings.WEBHOOK_PATH, handle_update)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, settings.WEBHOOK_HOST, settings.WEBHOOK_PORT).start()
+    await webhook.register_webhook(dp)
+    return runner
+
+
+async def ingest(workers: UpdateWorkers) -> None:
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stopped.set)
+    watching = asyncio.create_task(watch_workers(workers))
+    if settings.BOT_MODE == 'webhook':
+        runner = await start_ingest_webhook(workers)
+        await stopped.wait()
+        await runner.cleanup()
+    else:
+        polling = asyncio.create_task(poll_updates(workers))
+        await stopped.wait()
+        polling.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await polling
+    # Workers exit once their queues are stopped, they must not be started again then
+    watching.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await watching
+    await (await bot.get_session()).close()
+
+
+def run_ingest(workers_count: int) -> None:
+    """Receive updates in this process and process them in ``workers_count`` worker processes"""
+    workers = UpdateWorkers(workers_count)
+    logger.info(f'Ingesting updates for {workers_count} workers')
+    try:
+        asyncio.run(ingest(workers))
+    finally:
+        workers.stop()
+
+
+async def process_chat_update(previous_task: asyncio.Task | None, update: Update) -> None:
+    if previous_task is not None:
+        await asyncio.wait((previous_task,))
+    await webhook.process_update(dp, update)
+
+
+async def process_updates(queue: Queue) -> None:
+    """Process updates of different chats concurrently and updates of one chat one by one"""
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(settings.WORKER_MAX_IN_FLIGHT_UPDATES)
+    last_chat_tasks: dict[int, asyncio.Task] = {}
+
+    def forget_task(chat_id: int, task: asyncio.Task) -> None:
+        semaphore.release()
+        if last_chat_tasks.get(chat_id) is task:
+            del last_chat_tasks[chat_id]
+
+    while True:
+        raw_update = await loop.run_in_executor(None, queue.get)
+        if raw_update is None:
+            break
+        await semaphore.acquire()
+        chat_id = get_shard_key(raw_update)
+        task = asyncio.create_task(process_chat_update(last_chat_tasks.get(chat_id), Update(**raw_update)))
+        task.add_done_callback(lambda done_task, chat_id=chat_id: forget_task(chat_id, done_task))
+        last_chat_tasks[chat_id] = task
+    if last_chat_tasks:
+        await asyncio.wait(last_chat_tasks.values())
+
+
+async def work(number: int, queue: Queue) -> None:
+    # main imports this module to start the ingest
+    import main
+    Bot.set_current(bot)
+    Dispatcher.set_current(dp)
+    dp[main.WORKER_NUMBER_KEY] = number
+    await main.on_startup(dp)
+    try:
+        await process_updates(queue)
+    finally:
+        await main.on_shutdown(dp)
+        await dp.storage.close()
+        await dp.storage.wait_closed()
+        await (await bot.get_session()).close()
+
+
+def run_worker(number: int, queue: Queue) -> None:
+    # The ingest process stops workers through their queues once it has stopped receiving updates
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    utils.configure_logging()
+    # Registers the handlers on the dispatcher
+    import handlers  # noqa: F401
+    asyncio.run(work(number, queue))
+    logger.info(f'Update worker {number} stopped')